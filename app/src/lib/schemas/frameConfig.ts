@@ -5,10 +5,17 @@ export const FrameConfig = z
     z.object({
       type: z.literal('num'),
       num: z.coerce.number(),
+      dedup: z.coerce.number().int().nonnegative().optional(),
+    }),
+    z.object({
+      type: z.literal('sharpest'),
+      num: z.coerce.number(),
+      dedup: z.coerce.number().int().nonnegative().optional(),
     }),
     z.object({
       type: z.literal('list'),
       frames: z.array(z.coerce.number()),
+      dedup: z.coerce.number().int().nonnegative().optional(),
     }),
   ])
   .default({ type: 'num', num: 100 })
@@ -0,0 +1,16 @@
+import { z } from 'zod'
+
+export const MappingConfig = z
+  .discriminatedUnion('type', [
+    z.object({ type: z.literal('incremental') }),
+    z.object({
+      type: z.literal('partitioned'),
+      clusterSize: z.coerce.number().int().positive().optional(),
+      overlap: z.coerce.number().nonnegative().optional(),
+      minInliers: z.coerce.number().int().nonnegative().optional(),
+    }),
+  ])
+  .default({ type: 'incremental' })
+
+export type MappingConfig = z.infer<typeof MappingConfig>
+export type MappingType = MappingConfig['type']
@@ -3,11 +3,13 @@ import { z } from 'zod'
 import { FrameConfig } from './frameConfig'
 import { PairingConfig } from './pairingConfig'
 import { MatchingConfig } from './matchingConfig'
+import { MappingConfig } from './mappingConfig'
 
 export const ModelConfig = z.object({
   frames: z.record(FrameConfig).default({}),
   pairing: PairingConfig,
   matching: MatchingConfig,
+  mapping: MappingConfig,
   minMatchScore: z.coerce.number().optional(),
   numIter: z.coerce.number().int().default(7000),
 })
@@ -8,6 +8,12 @@ export const PairingConfig = z
       sequential: z.coerce.number().nonnegative(),
       retrieval: z.coerce.number().nonnegative(),
     }),
+    z.object({
+      type: z.literal('budget'),
+      budget: z.coerce.number().int().positive(),
+      sequential: z.coerce.number().nonnegative().optional(),
+      retrieval: z.coerce.number().nonnegative().optional(),
+    }),
   ])
   .default({ type: 'exhaustive' })
 
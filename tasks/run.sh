@@ -11,4 +11,4 @@ docker run --rm \
     --env-file=$ENV_FILE \
     -v $WORKSPACE:/workspace \
     -v $HOME/.cache:/root/.cache \
-    worker process_projects.py
+    worker process_projects.py --daemon --slots ${WORKER_SLOTS:-1}
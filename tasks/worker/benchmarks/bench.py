@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import click
+import numpy as np
+
+BIN = Path(__file__).resolve().parent.parent / "bin"
+sys.path.insert(0, str(BIN))
+
+# Compared against by default, re-record it on the benchmark machine with
+# `bench.py run -o benchmarks/baseline.json` after an intended change
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+SIZES = {
+    "quick": {
+        "video_frames": 150,
+        "video_size": [640, 360],
+        "images": 300,
+        "keypoints": 2048,
+        "matches": 512,
+        "sequential": 10,
+        "descriptor_dim": 4096,
+        "retrieval": 20,
+        "models": 3,
+        "model_images": 300,
+        "model_points": 100_000,
+    },
+    "full": {
+        "video_frames": 900,
+        "video_size": [1920, 1080],
+        "images": 2000,
+        "keypoints": 8192,
+        "matches": 2048,
+        "sequential": 20,
+        "descriptor_dim": 4096,
+        "retrieval": 50,
+        "models": 5,
+        "model_images": 2000,
+        "model_points": 2_000_000,
+    },
+}
+
+SEED = 0
+
+
+def frame_names(num: int) -> list[str]:
+    return [f"video_{i:05d}.jpg" for i in range(num)]
+
+
+def make_video(path: Path, num_frames: int, size: tuple[int, int]) -> Path:
+    import cv2
+
+    width, height = size
+    rng = np.random.default_rng(SEED)
+    texture = rng.integers(0, 256, (height // 8 + 1, width // 4 + 1, 3), np.uint8)
+    texture = cv2.resize(texture, (width * 2, height + 8), cv2.INTER_CUBIC)
+
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height)
+    )
+    for i in range(num_frames):
+        # Slow pan over the texture, with sensor noise
+        x = int(i * width / num_frames)
+        frame = texture[:height, x : x + width].copy()
+        frame = cv2.add(frame, rng.integers(0, 8, frame.shape, np.uint8))
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def make_images(path: Path, num: int) -> list[str]:
+    import cv2
+
+    path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(SEED)
+    tile = rng.integers(0, 256, (48, 64, 3), np.uint8)
+    for name in frame_names(num):
+        cv2.imwrite(str(path / name), np.roll(tile, rng.integers(64), axis=1))
+    return frame_names(num)
+
+
+def make_keypoints(rng: np.random.Generator, num: int) -> np.ndarray:
+    return (rng.random((num, 2)) * (1920, 1080)).astype(np.float32)
+
+
+def make_features(path: Path, names: list[str], num_keypoints: int):
+    import h5py
+
+    rng = np.random.default_rng(SEED)
+    with h5py.File(path, "w") as f:
+        for name in names:
+            group = f.create_group(name)
+            group.create_dataset("keypoints", data=make_keypoints(rng, num_keypoints))
+            group.create_dataset(
+                "scores", data=rng.random(num_keypoints, dtype=np.float32)
+            )
+
+
+def make_pairs(path: Path, names: list[str], window: int) -> list[tuple[str, str]]:
+    pairs = [
+        (names[i], names[j])
+        for i in range(len(names))
+        for j in range(i + 1, min(i + window + 1, len(names)))
+    ]
+    with open(path, "w") as f:
+        f.writelines(f"{n0} {n1}\n" for n0, n1 in pairs)
+    return pairs
+
+
+def make_matches(
+    path: Path, pairs: list[tuple[str, str]], num_keypoints: int, num_matches: int
+):
+    import h5py
+    from hloc.utils.io import names_to_pair
+
+    rng = np.random.default_rng(SEED)
+    with h5py.File(path, "w") as f:
+        for name0, name1 in pairs:
+            matches0 = np.full(num_keypoints, -1, np.int16)
+            matched = rng.choice(num_keypoints, num_matches, replace=False)
+            matches0[matched] = rng.permutation(num_keypoints)[:num_matches]
+
+            group = f.create_group(names_to_pair(name0, name1))
+            group.create_dataset("matches0", data=matches0)
+            group.create_dataset(
+                "matching_scores0",
+                data=(matches0 != -1) * rng.random(num_keypoints, np.float32),
+            )
+
+
+def make_database(path: Path, names: list[str]):
+    from database import open_database
+
+    db = open_database(str(path), overwrite=True)
+    camera_id = db.add_camera(1, 1920, 1080, np.array([1600.0, 960.0, 540.0]))
+    for name in names:
+        db.add_image(name, camera_id)
+    db.commit()
+    db.close()
+
+
+def scatter(buf: np.ndarray, offsets: np.ndarray, records: np.ndarray):
+    """Write one record at each byte offset of `buf`"""
+    columns = np.arange(records.dtype.itemsize)
+    buf[offsets[:, None] + columns] = records.view(np.uint8).reshape(len(records), -1)
+
+
+def make_model(path: Path, num_images: int, num_points: int):
+    from colmap_model import COUNT, IMAGE, POINT2D, POINT3D, TRACK
+
+    path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(SEED)
+
+    with open(path / "cameras.bin", "wb") as f:
+        f.write(COUNT.pack(1))
+        # A SIMPLE_RADIAL camera
+        f.write(np.array([1, 2], "<i4").tobytes())
+        f.write(np.array([1920, 1080], "<u8").tobytes())
+        f.write(np.array([1600.0, 960.0, 540.0, 0.0], "<f8").tobytes())
+
+    lengths = rng.integers(2, 8, num_points)
+    observations = np.zeros(num_images, np.int64)
+    np.add.at(observations, rng.integers(0, num_images, lengths.sum()), 1)
+
+    with open(path / "images.bin", "wb") as f:
+        f.write(COUNT.pack(num_images))
+        for i, name in enumerate(frame_names(num_images)):
+            image = np.zeros(1, IMAGE)
+            image["image_id"], image["camera_id"], image["qvec"][:, 0] = i + 1, 1, 1
+            f.write(image.tobytes() + name.encode() + b"\0")
+            f.write(COUNT.pack(observations[i]))
+            points = np.zeros(observations[i], POINT2D)
+            points["xy"] = make_keypoints(rng, observations[i])
+            points["point3D_id"] = rng.integers(1, num_points + 1, observations[i])
+            f.write(points.tobytes())
+
+    sizes = POINT3D.itemsize + lengths * TRACK.itemsize
+    offsets = COUNT.size + np.cumsum(sizes) - sizes
+    buf = np.zeros(COUNT.size + sizes.sum(), np.uint8)
+    buf[: COUNT.size] = np.frombuffer(COUNT.pack(num_points), np.uint8)
+
+    points = np.zeros(num_points, POINT3D)
+    points["point3D_id"] = np.arange(1, num_points + 1)
+    points["xyz"] = rng.normal(size=(num_points, 3))
+    points["rgb"] = rng.integers(0, 256, (num_points, 3))
+    points["error"] = rng.gamma(2.0, 0.5, num_points)
+    points["track_length"] = lengths
+    scatter(buf, offsets, points)
+
+    tracks = np.zeros(lengths.sum(), TRACK)
+    tracks["image_id"] = rng.integers(1, num_images + 1, len(tracks))
+    first = np.cumsum(lengths) - lengths
+    within = np.arange(len(tracks)) - np.repeat(first, lengths)
+    track_offsets = np.repeat(offsets + POINT3D.itemsize, lengths)
+    scatter(buf, track_offsets + within * TRACK.itemsize, tracks)
+
+    buf.tofile(path / "points3D.bin")
+
+
+def setup_video(workdir: Path, size: dict[str, Any]):
+    make_video(workdir / "video.mp4", size["video_frames"], tuple(size["video_size"]))
+    (workdir / "frames").mkdir()
+
+
+def run_extract_frames(workdir: Path, size: dict[str, Any]) -> int:
+    from process_uploads import Deduplicator, FrameWriter, Video
+
+    frames = list(range(0, size["video_frames"], 3))
+    with Video(workdir / "video.mp4") as video:
+        with FrameWriter(workdir / "frames", "jpg", 95, 0, 2, 4) as writer:
+            video.extract_frames(frames, writer, Deduplicator(4))
+    return len(frames)
+
+
+def run_extract_sharpest(workdir: Path, size: dict[str, Any]) -> int:
+    from process_uploads import Deduplicator, FrameWriter, Video
+
+    num = size["video_frames"]
+    windows = [(start, min(start + 5, num)) for start in range(0, num, 5)]
+    with Video(workdir / "video.mp4") as video:
+        with FrameWriter(workdir / "frames", "jpg", 95, 0, 2, 4) as writer:
+            video.extract_sharpest(windows, writer, Deduplicator(None))
+    return num
+
+
+def setup_images(workdir: Path, size: dict[str, Any]):
+    make_images(workdir / "images", size["images"])
+
+
+def run_pair_sequential(workdir: Path, size: dict[str, Any]) -> int:
+    from pairing import pair_sequential, write_pairs
+
+    names = sorted(p.name for p in (workdir / "images").iterdir())
+    pairs = pair_sequential(names, size["sequential"])
+    return write_pairs(pairs, workdir / "pairs.txt")
+
+
+def run_pair_exhaustive(workdir: Path, size: dict[str, Any]) -> int:
+    from pairing import pair_exhaustive, write_pairs
+
+    names = sorted(p.name for p in (workdir / "images").iterdir())
+    return write_pairs(pair_exhaustive(names), workdir / "pairs.txt")
+
+
+def setup_descriptors(workdir: Path, size: dict[str, Any]):
+    rng = np.random.default_rng(SEED)
+    descriptors = rng.normal(size=(size["images"], size["descriptor_dim"]))
+    descriptors /= np.linalg.norm(descriptors, axis=1, keepdims=True)
+    np.save(workdir / "descriptors.npy", descriptors.astype(np.float32))
+
+
+def run_pair_retrieval(workdir: Path, size: dict[str, Any]) -> int:
+    from pairing import retrieval_pairs, write_pairs
+
+    descriptors = np.load(workdir / "descriptors.npy")
+    names = frame_names(len(descriptors))
+    pairs = retrieval_pairs(descriptors, names, size["retrieval"])
+    return write_pairs(pairs, workdir / "pairs.txt")
+
+
+def setup_features(workdir: Path, size: dict[str, Any]):
+    names = frame_names(size["images"])
+    make_features(workdir / "features.h5", names, size["keypoints"])
+    make_database(workdir / "database.db", names)
+
+
+def run_import_features(workdir: Path, size: dict[str, Any]) -> int:
+    from database import import_features, open_database
+
+    db = open_database(str(workdir / "database.db"))
+    import_features(db, str(workdir / "features.h5"))
+    db.close()
+    return size["images"]
+
+
+def setup_matches(workdir: Path, size: dict[str, Any]):
+    names = frame_names(size["images"])
+    pairs = make_pairs(workdir / "pairs.txt", names, size["sequential"])
+    make_matches(workdir / "matches.h5", pairs, size["keypoints"], size["matches"])
+    make_database(workdir / "database.db", names)
+
+
+def run_import_matches(workdir: Path, size: dict[str, Any]) -> int:
+    from database import import_matches, open_database
+
+    db = open_database(str(workdir / "database.db"))
+    # Geometric verification is COLMAP's, not ours
+    import_matches(
+        db,
+        str(workdir / "matches.h5"),
+        str(workdir / "pairs.txt"),
+        skip_geometric_verification=True,
+    )
+    (num,) = db.execute("SELECT count(*) FROM matches;").fetchone()
+    db.close()
+    return num
+
+
+def setup_models(workdir: Path, size: dict[str, Any]):
+    for i in range(size["models"]):
+        # Candidate models of decreasing size, like COLMAP's output
+        scale = 2**i
+        make_model(
+            workdir / "sparse" / str(i),
+            size["model_images"] // scale,
+            size["model_points"] // scale,
+        )
+
+
+def run_select_largest_model(workdir: Path, size: dict[str, Any]) -> int:
+    from select_largest_model import cli
+
+    cli.main([str(workdir / "sparse")], standalone_mode=False)
+    return size["model_points"]
+
+
+# Setup, hot path and the unit of the items the hot path returns
+BENCHMARKS: dict[str, tuple[Callable, Callable, str]] = {
+    "extract_frames": (setup_video, run_extract_frames, "frames"),
+    "extract_sharpest": (setup_video, run_extract_sharpest, "frames"),
+    "pair_sequential": (setup_images, run_pair_sequential, "pairs"),
+    "pair_exhaustive": (setup_images, run_pair_exhaustive, "pairs"),
+    "pair_retrieval": (setup_descriptors, run_pair_retrieval, "pairs"),
+    "import_features": (setup_features, run_import_features, "images"),
+    "import_matches": (setup_matches, run_import_matches, "pairs"),
+    "select_largest_model": (setup_models, run_select_largest_model, "points"),
+}
+
+
+def setup(name: str, workdir: str, size: dict[str, Any]):
+    BENCHMARKS[name][0](Path(workdir), size)
+
+
+def measure(name: str, workdir: str, size: dict[str, Any]) -> dict[str, Any]:
+    start = time.perf_counter()
+    items = BENCHMARKS[name][1](Path(workdir), size)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "items": items,
+        # Linux reports kilobytes
+        "peakRss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def in_child(fn: Callable, *args) -> Any:
+    # A fresh interpreter per step, so that peak RSS only covers the hot path
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def run_benchmark(name: str, size: dict[str, Any], repeat: int) -> dict[str, Any]:
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as workdir:
+            in_child(setup, name, workdir, size)
+            runs.append(in_child(measure, name, workdir, size))
+
+    best = min(runs, key=lambda run: run["seconds"])
+    return {
+        "seconds": round(best["seconds"], 4),
+        "items": best["items"],
+        "unit": BENCHMARKS[name][2],
+        "throughput": round(best["items"] / best["seconds"], 2),
+        "peakRss": max(run["peakRss"] for run in runs),
+    }
+
+
+def compare(
+    results: dict[str, Any], baseline: dict[str, Any], tolerance: float
+) -> list[str]:
+    if baseline.get("params") != results["params"]:
+        print("Baseline was recorded with other parameters, skipping")
+        return []
+
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None or "skipped" in result or "skipped" in base:
+            continue
+
+        speed = result["throughput"] / base["throughput"]
+        memory = result["peakRss"] / base["peakRss"]
+        print(f"{name:24} throughput {speed - 1:+7.1%}  peak RSS {memory - 1:+7.1%}")
+        if speed < 1 - tolerance or memory > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+@click.group()
+def cli():
+    pass
+
+
+def parse_resolution(ctx, param, value: Optional[str]) -> Optional[list[int]]:
+    if value is None:
+        return None
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise click.BadParameter(f"{value} is not WIDTHxHEIGHT")
+    return [width, height]
+
+
+@cli.command("list")
+def list_cmd():
+    for name, (_, _, unit) in BENCHMARKS.items():
+        print(f"{name:24} {unit}/s")
+
+
+@cli.command()
+@click.argument("names", nargs=-1)
+@click.option("-s", "--size", type=click.Choice(list(SIZES)), default="quick")
+@click.option("-n", "--repeat", type=int, default=3, help="Best of n runs")
+@click.option(
+    "-o", "--output", type=click.Path(), help="Write results, e.g. as baseline"
+)
+@click.option(
+    "-b",
+    "--baseline",
+    type=click.Path(),
+    default=str(BASELINE),
+    help="Results to compare against, if present",
+)
+@click.option("-t", "--tolerance", type=float, default=0.15)
+@click.option(
+    "--video-frames",
+    type=click.IntRange(min=1),
+    help="Length of the benchmark video, overrides the size",
+)
+@click.option(
+    "--video-size",
+    callback=parse_resolution,
+    help="Resolution of the benchmark video as WIDTHxHEIGHT, overrides the size",
+)
+def run(names, size, repeat, output, baseline, tolerance, video_frames, video_size):
+    """Run the benchmarks NAMES, all by default"""
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise click.BadParameter(f"Unknown benchmarks {', '.join(sorted(unknown))}")
+
+    params = dict(SIZES[size])
+    if video_frames is not None:
+        params["video_frames"] = video_frames
+    if video_size is not None:
+        params["video_size"] = video_size
+
+    results = {
+        "size": size,
+        # Results are only compared against a baseline of the same parameters
+        "params": params,
+        "machine": {
+            "python": platform.python_version(),
+            "processor": platform.processor() or platform.machine(),
+        },
+        "benchmarks": {},
+    }
+    for name in names or BENCHMARKS:
+        try:
+            result = run_benchmark(name, params, repeat)
+        except ImportError as e:
+            result = {"skipped": str(e)}
+            print(f"{name:24} skipped: {e}")
+        else:
+            print(
+                f"{name:24} {result['throughput']:12.1f} {result['unit']}/s "
+                f"{result['seconds']:8.3f}s {result['peakRss'] / 2**20:8.1f} MiB"
+            )
+        results["benchmarks"][name] = result
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    # Not against the results just written when recording a new baseline
+    recording = output and Path(output).resolve() == Path(baseline or "").resolve()
+    if baseline and Path(baseline).exists() and not recording:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
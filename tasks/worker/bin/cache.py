@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+import fcntl
+import hashlib
+import json
+import os
+import posixpath
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Iterable
+import uuid
+
+import click
+import h5py
+import numpy as np
+from hloc.utils.io import find_pair, names_to_pair
+
+CACHE_DIR = Path(
+    os.environ.get("SPLATBELT_CACHE", Path.home() / ".cache" / "splatbelt")
+)
+
+# Total size of all cache entries in GiB
+CACHE_SIZE = float(os.environ.get("SPLATBELT_CACHE_SIZE", 50))
+
+# Unindexed packs older than this in seconds were left by a killed writer
+ORPHAN_AGE = 3600
+
+# Keys per lookup query, below the SQLite variable limit
+QUERY_SIZE = 500
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packs (
+    pack TEXT PRIMARY KEY NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    pack TEXT NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_pack ON entries (pack);
+"""
+
+
+def hash_file(path: Path, chunk_size: int = 2**20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_files(paths: Iterable[Path]) -> list[str]:
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(hash_file, paths))
+
+
+def hash_keypoints(features: Path, names: list[str]) -> dict[str, str]:
+    with h5py.File(features, "r") as f:
+        return {
+            name: hashlib.sha256(f[name]["keypoints"][()].tobytes()).hexdigest()
+            for name in names
+        }
+
+
+def hash_config(config: dict) -> str:
+    # The output name does not change the content
+    config = {k: v for k, v in config.items() if k != "output"}
+    encoded = json.dumps(config, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def copy_group(src: h5py.Group, dst: h5py.File, name: str):
+    parent = posixpath.dirname(name)
+    if parent:
+        dst.require_group(parent)
+    src.file.copy(src, dst, name=name)
+
+
+class H5Cache:
+    """Content-addressed store of HDF5 groups
+
+    Entries are packed into one HDF5 file per store call, a SQLite index
+    shared by all namespaces maps keys to packs. Reads bump the last use
+    of a pack, whole packs are evicted in LRU order.
+    """
+
+    def __init__(self, namespace: str, root: Path = CACHE_DIR):
+        self.root = Path(root)
+        self.namespace = namespace
+        self.dir = self.root / namespace
+        self.index = open_index(self.root)
+
+    def lookup(self, keys: list[str]) -> dict[str, str]:
+        packs = {}
+        for start in range(0, len(keys), QUERY_SIZE):
+            batch = keys[start : start + QUERY_SIZE]
+            packs.update(
+                self.index.execute(
+                    "SELECT key, pack FROM entries WHERE namespace = ? "
+                    f"AND key IN ({', '.join('?' * len(batch))});",
+                    (self.namespace, *batch),
+                )
+            )
+        return packs
+
+    def get_many(self, keys: dict[str, str], dst: h5py.File) -> set[str]:
+        """Copy the cached groups of `keys` (name -> key) to `dst`
+
+        Returns the names that were found.
+        """
+        packs = self.lookup(list(set(keys.values())))
+        by_pack = defaultdict(list)
+        for name, key in keys.items():
+            if key in packs:
+                by_pack[packs[key]].append((name, key))
+
+        found, used = set(), []
+        for pack, entries in by_pack.items():
+            # The pack may be evicted by another job in the meantime
+            try:
+                with h5py.File(self.root / pack, "r") as f:
+                    for name, key in entries:
+                        if key in f:
+                            copy_group(f[key], dst, name)
+                            found.add(name)
+            except OSError:
+                continue
+            used.append((time.time(), pack))
+
+        with self.index:
+            self.index.executemany("UPDATE packs SET used = ? WHERE pack = ?;", used)
+        return found
+
+    def put_many(self, entries: Iterable[tuple[str, h5py.Group]]):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        path = self.dir / f"{uuid.uuid4().hex}.h5"
+        tmp = path.with_suffix(".tmp")
+
+        keys = []
+        with h5py.File(tmp, "w") as f:
+            for key, group in entries:
+                if key not in f:
+                    copy_group(group, f, key)
+                    keys.append(key)
+        if not keys:
+            tmp.unlink()
+            return
+        os.replace(tmp, path)
+
+        pack = path.relative_to(self.root).as_posix()
+        with self.index:
+            self.index.execute(
+                "INSERT INTO packs VALUES (?, ?, ?);",
+                (pack, path.stat().st_size, time.time()),
+            )
+            # Concurrent jobs may store the same key, the last pack wins
+            self.index.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?);",
+                ((self.namespace, key, pack) for key in keys),
+            )
+
+    def evict(self, max_size: float = CACHE_SIZE) -> int:
+        return evict(self.root, max_size)
+
+
+def open_index(root: Path) -> sqlite3.Connection:
+    root.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(root / "index.db", timeout=60)
+    db.execute("PRAGMA journal_mode=WAL;")
+    db.executescript(INDEX_SCHEMA)
+    return db
+
+
+def remove_orphans(root: Path, index: sqlite3.Connection) -> int:
+    """Delete temporary and unindexed packs left by killed writers"""
+    packs = {pack for (pack,) in index.execute("SELECT pack FROM packs;")}
+    cutoff = time.time() - ORPHAN_AGE
+
+    removed = 0
+    for namespace in ("features", "matches"):
+        for path in (root / namespace).rglob("*"):
+            if path.suffix not in {".h5", ".tmp"}:
+                continue
+            if path.relative_to(root).as_posix() in packs:
+                continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def evict(root: Path = CACHE_DIR, max_size: float = CACHE_SIZE) -> int:
+    root = Path(root)
+    with closing(open_index(root)) as index:
+        removed = remove_orphans(root, index)
+
+        max_bytes = max_size * 2**30
+        (total,) = index.execute("SELECT COALESCE(SUM(size), 0) FROM packs;").fetchone()
+        packs = index.execute("SELECT pack, size FROM packs ORDER BY used;").fetchall()
+        for pack, size in packs:
+            if total <= max_bytes:
+                break
+            with index:
+                index.execute("DELETE FROM entries WHERE pack = ?;", (pack,))
+                index.execute("DELETE FROM packs WHERE pack = ?;", (pack,))
+            (root / pack).unlink(missing_ok=True)
+            total -= size
+            removed += 1
+    return removed
+
+
+class FeatureCache(H5Cache):
+    def __init__(self, feature_config: dict, root: Path = CACHE_DIR):
+        super().__init__(f"features/{hash_config(feature_config)}", root)
+
+    def assemble(
+        self, images: Path, features: Path
+    ) -> tuple[dict[str, str], list[str]]:
+        """Write cached features of `images` to `features`
+
+        Returns the content hash of every image and the names of the images
+        that still need to be extracted.
+        """
+        names = sorted(p.name for p in images.iterdir() if p.is_file())
+        hashes = dict(zip(names, hash_files(images / name for name in names)))
+
+        features.unlink(missing_ok=True)
+        with h5py.File(features, "w") as f:
+            found = self.get_many(hashes, f)
+        misses = [name for name in names if name not in found]
+
+        print(f"Feature cache: {len(found)} hits, {len(misses)} misses")
+        return hashes, misses
+
+    def store(self, features: Path, hashes: dict[str, str], names: list[str]):
+        with h5py.File(features, "r") as f:
+            self.put_many((hashes[name], f[name]) for name in names)
+
+
+class MatchCache(H5Cache):
+    """Matches of an image pair, keyed by both image and keypoint hashes
+
+    Match indices refer to the keypoints they were computed from. Features
+    are evicted independently of matches and may come out differently when
+    extracted again, so the keypoints are part of the key.
+
+    Keys are ordered, a pair that was matched as (B, A) is found by
+    looking up the reversed key.
+    """
+
+    def __init__(
+        self, matcher_config: dict, feature_config: dict, root: Path = CACHE_DIR
+    ):
+        configs = hash_config(matcher_config) + hash_config(feature_config)
+        digest = hashlib.sha256(configs.encode()).hexdigest()
+        super().__init__(f"matches/{digest[:16]}", root)
+
+    def key(self, hash0: str, hash1: str) -> str:
+        return hashlib.sha256(f"{hash0}{hash1}".encode()).hexdigest()
+
+    def assemble(
+        self, images: Path, features: Path, pairs: Path, matches: Path
+    ) -> tuple[dict[str, str], list[tuple[str, str]]]:
+        """Write cached matches of `pairs` to `matches`
+
+        Returns the image and keypoint hash of every paired image and the
+        pairs that still need to be matched.
+        """
+        with open(pairs) as f:
+            img_pairs = [tuple(line.split()) for line in f if line.strip()]
+
+        names = sorted({name for pair in img_pairs for name in pair})
+        image_hashes = hash_files(images / name for name in names)
+        keypoint_hashes = hash_keypoints(features, names)
+        hashes = {
+            name: hashlib.sha256(f"{h}{keypoint_hashes[name]}".encode()).hexdigest()
+            for name, h in zip(names, image_hashes)
+        }
+
+        unique, seen = [], set()
+        for name0, name1 in img_pairs:
+            if frozenset((name0, name1)) not in seen:
+                seen.add(frozenset((name0, name1)))
+                unique.append((name0, name1))
+
+        matches.unlink(missing_ok=True)
+        with h5py.File(matches, "w") as f:
+            found = self.get_many(
+                {
+                    names_to_pair(name0, name1): self.key(hashes[name0], hashes[name1])
+                    for name0, name1 in unique
+                },
+                f,
+            )
+            reverse = [p for p in unique if names_to_pair(*p) not in found]
+            found |= self.get_many(
+                {
+                    names_to_pair(name1, name0): self.key(hashes[name1], hashes[name0])
+                    for name0, name1 in reverse
+                },
+                f,
+            )
+
+        misses = [
+            (name0, name1)
+            for name0, name1 in reverse
+            if names_to_pair(name1, name0) not in found
+        ]
+        print(f"Match cache: {len(unique) - len(misses)} hits, {len(misses)} misses")
+        return hashes, misses
+
+    def store(
+        self, matches: Path, hashes: dict[str, str], pairs: list[tuple[str, str]]
+    ):
+        def entries(f: h5py.File):
+            for name0, name1 in pairs:
+                pair, reverse = find_pair(f, name0, name1)
+                if reverse:
+                    name0, name1 = name1, name0
+                yield self.key(hashes[name0], hashes[name1]), f[pair]
+
+        with h5py.File(matches, "r") as f:
+            self.put_many(entries(f))
+
+
+class DescriptorCache:
+    """Global image descriptors in an append-only memory-mappable array
+
+    Row `i` of `descriptors.f32` belongs to the image hash on line `i` of
+    `keys.txt`. Rows are small, so the array is not subject to eviction.
+    """
+
+    def __init__(self, config: dict, root: Path = CACHE_DIR):
+        self.dir = Path(root) / "global" / hash_config(config)
+        self.keys_path = self.dir / "keys.txt"
+        self.data_path = self.dir / "descriptors.f32"
+        self.dim_path = self.dir / "dim"
+
+    @contextmanager
+    def lock(self):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(self.dir / "lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def keys(self) -> dict[str, int]:
+        if not self.keys_path.exists():
+            return {}
+        with open(self.keys_path) as f:
+            return {key.strip(): row for row, key in enumerate(f)}
+
+    def array(self, num: int) -> np.ndarray:
+        dim = int(self.dim_path.read_text())
+        return np.memmap(self.data_path, np.float32, "r", shape=(num, dim))
+
+    def load(self, hashes: list[str]) -> np.ndarray:
+        keys = self.keys()
+        rows = [keys[h] for h in hashes]
+        return np.asarray(self.array(len(keys))[rows])
+
+    def append(self, hashes: list[str], descriptors: np.ndarray):
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        with self.lock():
+            # Keys are written last, a torn append leaves unreferenced rows
+            num = len(self.keys())
+            if num == 0:
+                self.dim_path.write_text(str(descriptors.shape[1]))
+
+            with open(self.data_path, "ab") as f:
+                f.truncate(num * descriptors[0].nbytes)
+                f.write(descriptors.tobytes())
+            with open(self.keys_path, "a") as f:
+                f.writelines(f"{h}\n" for h in hashes)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("evict")
+@click.option("-s", "--max-size", type=float, default=CACHE_SIZE, help="GiB")
+def evict_cmd(max_size):
+    print(f"Evicted {evict(CACHE_DIR, max_size)} cache packs")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+import click
+
+from transfer import Transfer, join_key
+
+# Bump to invalidate all checkpoints after incompatible pipeline changes
+VERSION = 2
+
+# Artifacts of each stage, the config keys, make variables passed in the
+# environment and the stages it depends on. A stage only writes its own
+# artifacts, so that restoring one stage never clobbers another
+STAGES = {
+    "images": {
+        "artifacts": ["images"],
+        "config": ["frames"],
+        "env": ["FRAME_FORMAT", "FRAME_QUALITY", "FRAME_MAX_SIZE"],
+        "inputs": ["uploads"],
+    },
+    "pairs.txt": {
+        "artifacts": ["pairs.txt"],
+        "config": ["pairing"],
+        "inputs": ["images"],
+    },
+    "features": {
+        "artifacts": ["features.h5", "features.db"],
+        "config": ["matching.features"],
+        "inputs": ["images"],
+    },
+    "database.db": {
+        "artifacts": ["matches.h5", "database.db"],
+        "config": ["matching", "minMatchScore"],
+        "inputs": ["pairs.txt", "features"],
+    },
+    "distorted/sparse/0": {
+        "artifacts": ["distorted/sparse/0"],
+        "config": ["mapping"],
+        "inputs": ["database.db"],
+    },
+}
+
+LOCAL_DIR = Path(".checkpoints")
+
+
+def prefix(stage: str) -> str:
+    return join_key(os.environ["PROJECT_ID"], "checkpoints", stage.replace("/", "_"))
+
+
+def get_config(key: str) -> Any:
+    value = json.loads(os.environ["CONFIG"])
+    for part in key.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+@lru_cache(maxsize=None)
+def get_transfer() -> Transfer:
+    return Transfer()
+
+
+def list_uploads() -> list:
+    uploads = get_transfer().list(join_key(os.environ["PROJECT_ID"], "uploads"))
+    return sorted([key, obj["Size"], obj["ETag"]] for key, obj in uploads.items())
+
+
+@lru_cache(maxsize=None)
+def fingerprint(stage: str) -> str:
+    if stage == "uploads":
+        payload = list_uploads()
+    else:
+        spec = STAGES[stage]
+        payload = {
+            "version": VERSION,
+            "stage": stage,
+            "config": [get_config(key) for key in spec["config"]],
+            "env": [os.environ.get(name) for name in spec.get("env", [])],
+            "inputs": [fingerprint(name) for name in spec["inputs"]],
+        }
+
+    encoded = json.dumps(payload, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def restore(stage: str) -> bool:
+    expected = fingerprint(stage)
+    artifacts = STAGES[stage]["artifacts"]
+
+    local = LOCAL_DIR / stage.replace("/", "_")
+    if local.exists() and local.read_text() == expected:
+        if all(Path(artifact).exists() for artifact in artifacts):
+            print(f"Stage {stage} is up to date")
+            return True
+
+    # The stage is rebuilt or restored next, an interrupted rebuild must not
+    # leave a marker that still matches the old artifacts, and a rebuild must
+    # not mix its output with theirs
+    local.unlink(missing_ok=True)
+    for artifact in artifacts:
+        remove(Path(artifact))
+
+    transfer = get_transfer()
+    manifest = transfer.get(join_key(prefix(stage), "manifest.json"))
+    if manifest is None or json.loads(manifest)["fingerprint"] != expected:
+        return False
+
+    for artifact in json.loads(manifest)["artifacts"]:
+        key = join_key(prefix(stage), artifact)
+        for _ in transfer.download(key, Path(artifact), delete=True):
+            pass
+
+    local.parent.mkdir(exist_ok=True)
+    local.write_text(expected)
+    print(f"Restored stage {stage} from checkpoint")
+    return True
+
+
+def save(stage: str):
+    transfer = get_transfer()
+
+    artifacts = []
+    for artifact in STAGES[stage]["artifacts"]:
+        if Path(artifact).exists():
+            key = join_key(prefix(stage), artifact)
+            transfer.upload(Path(artifact), key, delete=True)
+            artifacts.append(artifact)
+
+    # The manifest is written last, an interrupted save stays invalid
+    manifest = {"fingerprint": fingerprint(stage), "artifacts": artifacts}
+    manifest_key = join_key(prefix(stage), "manifest.json")
+    transfer.put(manifest_key, json.dumps(manifest).encode())
+    print(f"Saved checkpoint of stage {stage}")
+
+    local = LOCAL_DIR / stage.replace("/", "_")
+    local.parent.mkdir(exist_ok=True)
+    local.write_text(manifest["fingerprint"])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("restore")
+@click.argument("stage", type=click.Choice(list(STAGES)))
+def restore_cmd(stage):
+    """Restore STAGE if its checkpoint matches the inputs and config
+
+    Otherwise the stale artifacts of STAGE are removed for a rebuild.
+    """
+    sys.exit(0 if restore(stage) else 1)
+
+
+@cli.command("save")
+@click.argument("stage", type=click.Choice(list(STAGES)))
+def save_cmd(stage):
+    """Checkpoint the artifacts of STAGE"""
+    save(stage)
+
+
+@cli.command("fingerprint")
+@click.argument("stage", type=click.Choice(list(STAGES)))
+def fingerprint_cmd(stage):
+    print(fingerprint(stage))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import mmap
+import struct
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Union
+
+import click
+import numpy as np
+
+# Number of parameters of each COLMAP camera model id
+CAMERA_PARAMS = {0: 3, 1: 4, 2: 4, 3: 5, 4: 8, 5: 8, 6: 12, 7: 5, 8: 4, 9: 5, 10: 12}
+
+CAMERA = struct.Struct("<iiQQ")
+
+IMAGE = np.dtype(
+    [
+        ("image_id", "<u4"),
+        ("qvec", "<f8", 4),
+        ("tvec", "<f8", 3),
+        ("camera_id", "<u4"),
+    ]
+)
+POINT2D = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+
+POINT3D = np.dtype(
+    [
+        ("point3D_id", "<u8"),
+        ("xyz", "<f8", 3),
+        ("rgb", "u1", 3),
+        ("error", "<f8"),
+        ("track_length", "<u8"),
+    ]
+)
+TRACK = np.dtype([("image_id", "<u4"), ("point2D_idx", "<u4")])
+
+COUNT = struct.Struct("<Q")
+
+# Records gathered at once, bounds the size of the byte index
+GATHER_BLOCK = 2**16
+
+
+def gather(buf: np.ndarray, offsets: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Read one `dtype` record at each byte offset of `buf`"""
+    records = np.empty(len(offsets), dtype)
+    columns = np.arange(dtype.itemsize)
+    for i in range(0, len(offsets), GATHER_BLOCK):
+        block = offsets[i : i + GATHER_BLOCK]
+        records[i : i + len(block)] = buf[block[:, None] + columns].view(dtype)[:, 0]
+    return records
+
+
+def gather_lists(
+    buf: np.ndarray, starts: np.ndarray, lengths: np.ndarray, dtype: np.dtype
+) -> np.ndarray:
+    """Read `lengths[i]` consecutive records starting at each `starts[i]`"""
+    first = np.cumsum(lengths) - lengths
+    within = np.arange(lengths.sum()) - np.repeat(first, lengths)
+    offsets = np.repeat(starts, lengths) + within * dtype.itemsize
+    return gather(buf, offsets, dtype)
+
+
+class BinaryFile:
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = np.frombuffer(self.mmap, np.uint8)
+
+    def __len__(self) -> int:
+        return COUNT.unpack_from(self.mmap, 0)[0]
+
+
+class Model:
+    """Lazy reader of a COLMAP binary model
+
+    Only the record counts in the file headers are read up front. Records are
+    variable length, parsing them walks the memory-mapped file once to find
+    the record offsets and gathers the fields into NumPy arrays.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    @cached_property
+    def cameras_file(self) -> BinaryFile:
+        return BinaryFile(self.path / "cameras.bin")
+
+    @cached_property
+    def images_file(self) -> BinaryFile:
+        return BinaryFile(self.path / "images.bin")
+
+    @cached_property
+    def points_file(self) -> BinaryFile:
+        return BinaryFile(self.path / "points3D.bin")
+
+    @property
+    def num_cameras(self) -> int:
+        return len(self.cameras_file)
+
+    @property
+    def num_images(self) -> int:
+        return len(self.images_file)
+
+    @property
+    def num_points(self) -> int:
+        return len(self.points_file)
+
+    @property
+    def num_observations(self) -> int:
+        """Total track length, from the file size without parsing any record"""
+        size = len(self.points_file.mmap) - COUNT.size
+        return (size - self.num_points * POINT3D.itemsize) // TRACK.itemsize
+
+    @cached_property
+    def cameras(self) -> list[dict[str, Any]]:
+        data = self.cameras_file.mmap
+        cameras = []
+        offset = COUNT.size
+        for _ in range(self.num_cameras):
+            camera_id, model_id, width, height = CAMERA.unpack_from(data, offset)
+            offset += CAMERA.size
+
+            num_params = CAMERA_PARAMS[model_id]
+            params = np.frombuffer(data, "<f8", num_params, offset)
+            offset += 8 * num_params
+
+            cameras.append(
+                {
+                    "camera_id": camera_id,
+                    "model_id": model_id,
+                    "width": width,
+                    "height": height,
+                    "params": params.copy(),
+                }
+            )
+        return cameras
+
+    @cached_property
+    def _image_offsets(self) -> tuple[np.ndarray, list[str], np.ndarray]:
+        data = self.images_file.mmap
+        offsets = np.empty(self.num_images, np.int64)
+        lengths = np.empty(self.num_images, np.int64)
+        names = []
+
+        offset = COUNT.size
+        for i in range(self.num_images):
+            offsets[i] = offset
+            end = data.find(b"\0", offset + IMAGE.itemsize)
+            names.append(data[offset + IMAGE.itemsize : end].decode())
+            (lengths[i],) = COUNT.unpack_from(data, end + 1)
+            offset = end + 1 + COUNT.size + lengths[i] * POINT2D.itemsize
+
+        return offsets, names, lengths
+
+    @cached_property
+    def images(self) -> np.ndarray:
+        offsets, _, _ = self._image_offsets
+        return gather(self.images_file.buf, offsets, IMAGE)
+
+    @property
+    def image_names(self) -> list[str]:
+        return self._image_offsets[1]
+
+    @cached_property
+    def points2D(self) -> tuple[np.ndarray, np.ndarray]:
+        """Keypoints of all images and the offset of each image's first one"""
+        offsets, names, lengths = self._image_offsets
+        starts = offsets + IMAGE.itemsize
+        starts += np.array([len(name.encode()) + 1 for name in names], np.int64)
+        starts += COUNT.size
+        points = gather_lists(self.images_file.buf, starts, lengths, POINT2D)
+        return points, np.cumsum(lengths) - lengths
+
+    @cached_property
+    def _point_offsets(self) -> np.ndarray:
+        data = self.points_file.mmap
+        length_offset = POINT3D.fields["track_length"][1]
+        unpack = COUNT.unpack_from
+
+        offsets = []
+        offset = COUNT.size
+        for _ in range(self.num_points):
+            offsets.append(offset)
+            (length,) = unpack(data, offset + length_offset)
+            offset += POINT3D.itemsize + length * TRACK.itemsize
+
+        return np.array(offsets, np.int64)
+
+    @cached_property
+    def points3D(self) -> np.ndarray:
+        return gather(self.points_file.buf, self._point_offsets, POINT3D)
+
+    @cached_property
+    def tracks(self) -> tuple[np.ndarray, np.ndarray]:
+        """Track elements of all points and the offset of each point's first one"""
+        lengths = self.points3D["track_length"].astype(np.int64)
+        starts = self._point_offsets + POINT3D.itemsize
+        tracks = gather_lists(self.points_file.buf, starts, lengths, TRACK)
+        return tracks, np.cumsum(lengths) - lengths
+
+    def stats(self, errors: bool = True) -> dict[str, Any]:
+        """Model statistics, only the reprojection error parses the points"""
+        observations = self.num_observations
+        stats = {
+            "cameras": self.num_cameras,
+            "registeredImages": self.num_images,
+            "points": self.num_points,
+            "observations": observations,
+            "meanTrackLength": observations / max(self.num_points, 1),
+            "meanObservationsPerImage": observations / max(self.num_images, 1),
+        }
+        if errors:
+            points = self.points3D
+            error = float(points["error"].mean()) if len(points) else 0.0
+            stats["meanReprojectionError"] = error
+        return stats
+
+
+@click.command()
+@click.argument("model", type=click.Path(exists=True, file_okay=False))
+def cli(model):
+    """Print statistics of a COLMAP binary model"""
+    for key, value in Model(model).stats().items():
+        print(f"{key}: {value:.4g}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    cli()
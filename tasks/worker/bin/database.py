@@ -3,13 +3,32 @@
 import json
 import os
 import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
 import click
+import h5py
+import numpy as np
 import pycolmap
 from pycolmap import CameraMode
 
-from hloc.utils.database import COLMAPDatabase
-from hloc.utils.io import get_keypoints, get_matches
+from hloc.utils.database import COLMAPDatabase, MAX_IMAGE_ID, array_to_blob
+from hloc.utils.io import find_pair
+
+# Pairs written per executemany call
+BATCH_SIZE = 1024
+
+# Identity geometry used when importing unverified matches
+UNVERIFIED_GEOMETRY = (
+    2,
+    array_to_blob(np.eye(3)),
+    array_to_blob(np.eye(3)),
+    array_to_blob(np.eye(3)),
+    array_to_blob(np.array([1.0, 0.0, 0.0, 0.0])),
+    array_to_blob(np.zeros(3)),
+)
 
 
 def init_database(db: COLMAPDatabase) -> COLMAPDatabase:
@@ -17,118 +36,205 @@ def init_database(db: COLMAPDatabase) -> COLMAPDatabase:
     db.commit()
 
 
-def get_image_ids(db: COLMAPDatabase) -> dict[str, int]:
-    return dict(db.execute("SELECT name, image_id FROM images;"))
-
-
-@click.group()
-@click.argument("database", type=click.Path(), default="database.db")
-@click.option("-w", "--overwrite", is_flag=True, default=False)
-@click.pass_context
-def cli(ctx, database, overwrite):
-    ctx.ensure_object(dict)
-    ctx.obj["database"] = database
-
+def open_database(database: str, overwrite: bool = False) -> COLMAPDatabase:
     exists = os.path.exists(database)
     if exists and overwrite:
         os.remove(database)
         exists = False
 
-    conn = COLMAPDatabase.connect(database)
+    db = COLMAPDatabase.connect(database)
     if not exists:
-        init_database(conn)
+        init_database(db)
+    return db
 
-    ctx.obj["conn"] = conn
 
+def get_database_path(db: COLMAPDatabase) -> str:
+    _, _, path = db.execute("PRAGMA database_list;").fetchone()
+    return path
 
-@cli.command()
-@click.argument("images", type=click.Path(exists=True), required=True)
-@click.option("--image-list", default=None, help="Path to image list or '-' for stdin")
-@click.option("--options", default=None)
-@click.pass_obj
-def import_images(obj, images, image_list, options):
-    if image_list is None:
-        image_list = []
-    elif image_list == "-":
-        image_list = [line.strip() for line in sys.stdin.readlines()]
-    else:
-        with open(image_list) as f:
-            image_list = [line.strip() for line in f.readlines()]
 
-    if options is None:
-        options = {}
-    else:
-        options = json.loads(options)
+def get_image_ids(db: COLMAPDatabase) -> dict[str, int]:
+    return dict(db.execute("SELECT name, image_id FROM images;"))
+
 
+@contextmanager
+def bulk_import(db: COLMAPDatabase, what: str) -> Iterator[COLMAPDatabase]:
+    # Nothing to recover from a crashed import, the database gets rebuilt
+    db.execute("PRAGMA journal_mode=WAL;")
+    db.execute("PRAGMA synchronous=OFF;")
+    start = time.perf_counter()
+    try:
+        yield db
+        db.commit()
+    finally:
+        db.execute("PRAGMA synchronous=NORMAL;")
+    print(f"Imported {what} in {time.perf_counter() - start:.2f}s")
+
+
+def iter_keypoints(
+    features: str, image_ids: dict[str, int]
+) -> Iterator[tuple[int, int, int, bytes]]:
+    with h5py.File(str(features), "r", libver="latest") as f:
+        for name, image_id in sorted(image_ids.items(), key=lambda item: item[1]):
+            keypoints = np.asarray(f[name]["keypoints"], dtype=np.float32)
+            keypoints += 0.5  # COLMAP origin
+            yield (image_id,) + keypoints.shape + (array_to_blob(keypoints),)
+
+
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+def read_pairs(pairs: str, image_ids: dict[str, int]) -> list[tuple[str, str, int]]:
+    with open(pairs) as f:
+        names = [line.split() for line in f if line.strip()]
+    if not names:
+        return []
+
+    ids = np.array([[image_ids[n0], image_ids[n1]] for n0, n1 in names], np.int64)
+    pair_ids = ids.min(axis=1) * MAX_IMAGE_ID + ids.max(axis=1)
+
+    # Keep the first occurrence of each unordered pair
+    _, first = np.unique(pair_ids, return_index=True)
+    first.sort()
+    return [(*names[i], int(pair_ids[i])) for i in first]
+
+
+def iter_matches(
+    match_file: str,
+    pairs: list[tuple[str, str, int]],
+    image_ids: dict[str, int],
+    min_match_score: Optional[float] = None,
+) -> Iterator[tuple[int, np.ndarray]]:
+    with h5py.File(str(match_file), "r", libver="latest") as f:
+        for name0, name1, pair_id in pairs:
+            key, reverse = find_pair(f, name0, name1)
+            matches0 = f[key]["matches0"].__array__()
+
+            valid = matches0 != -1
+            if min_match_score:
+                valid &= f[key]["matching_scores0"].__array__() > min_match_score
+
+            idx = np.flatnonzero(valid)
+            matches = np.stack([idx, matches0[idx]], -1)
+
+            # COLMAP stores matches from the smaller to the larger image id
+            if reverse != (image_ids[name0] > image_ids[name1]):
+                matches = matches[:, ::-1]
+
+            yield pair_id, np.ascontiguousarray(matches, np.uint32)
+
+
+def import_images(
+    db: COLMAPDatabase,
+    images: str,
+    image_list: Optional[list[str]] = None,
+    options: Optional[dict] = None,
+):
     if not os.listdir(images):
         raise IOError(f"No images found in {images}.")
 
+    # pycolmap writes through its own connection
+    db.commit()
     with pycolmap.ostream():
         pycolmap.import_images(
-            obj["database"],
-            images,
+            get_database_path(db),
+            str(images),
             CameraMode.SINGLE,
-            image_list=image_list,
-            options=options,
+            image_list=image_list or [],
+            options=options or {},
         )
 
 
-@cli.command()
-@click.argument("features", type=click.Path(exists=True), required=True)
-@click.pass_obj
-def import_features(obj, features):
-    db = obj["conn"]
+def import_features(db: COLMAPDatabase, features: str):
     image_ids = get_image_ids(db)
-    for image_name, image_id in image_ids.items():
-        keypoints = get_keypoints(features, image_name)
-        keypoints += 0.5  # COLMAP origin
-        db.add_keypoints(image_id, keypoints)
-    db.commit()
+    with bulk_import(db, f"keypoints of {len(image_ids)} images"):
+        db.executemany(
+            "INSERT INTO keypoints VALUES (?, ?, ?, ?);",
+            iter_keypoints(features, image_ids),
+        )
 
 
-@cli.command()
-@click.argument("match_file", type=click.Path(exists=True), required=True)
-@click.option("-p", "--pairs", type=click.Path(exists=True), required=True)
-@click.option("-nogv", "--skip-geometric-verification", is_flag=True, default=False)
-@click.option("-ms", "--min-match-score", type=float, default=None)
-@click.pass_obj
 def import_matches(
-    obj, match_file, pairs, skip_geometric_verification, min_match_score
+    db: COLMAPDatabase,
+    match_file: str,
+    pairs: str,
+    skip_geometric_verification: bool = False,
+    min_match_score: Optional[float] = None,
 ):
-    db = obj["conn"]
-
-    with open(pairs) as f:
-        img_pairs = [p.split() for p in f.readlines()]
-
     image_ids = get_image_ids(db)
+    img_pairs = read_pairs(pairs, image_ids)
 
-    matched = set()
-    for name0, name1 in img_pairs:
-        id0, id1 = image_ids[name0], image_ids[name1]
-        if len({(id0, id1), (id1, id0)} & matched) > 0:
-            continue
-
-        matches, scores = get_matches(match_file, name0, name1)
-        if min_match_score:
-            matches = matches[scores > min_match_score]
-
-        db.add_matches(id0, id1, matches)
-        matched |= {(id0, id1), (id1, id0)}
+    matches = iter_matches(match_file, img_pairs, image_ids, min_match_score)
+    with bulk_import(db, f"matches of {len(img_pairs)} pairs"):
+        for batch in batched(matches, BATCH_SIZE):
+            rows = [(pair_id,) + m.shape + (array_to_blob(m),) for pair_id, m in batch]
+            db.executemany("INSERT INTO matches VALUES (?, ?, ?, ?);", rows)
 
-        if skip_geometric_verification:
-            db.add_two_view_geometry(id0, id1, matches)
-
-    db.commit()
+            if skip_geometric_verification:
+                db.executemany(
+                    "INSERT INTO two_view_geometries "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                    [row + UNVERIFIED_GEOMETRY for row in rows],
+                )
 
     if not skip_geometric_verification:
         with pycolmap.ostream():
             pycolmap.verify_matches(
-                obj["database"],
-                pairs,
+                get_database_path(db),
+                str(pairs),
                 max_num_trials=20000,
                 min_inlier_ratio=0.1,
             )
 
 
+@click.group()
+@click.argument("database", type=click.Path(), default="database.db")
+@click.option("-w", "--overwrite", is_flag=True, default=False)
+@click.pass_context
+def cli(ctx, database, overwrite):
+    ctx.obj = open_database(database, overwrite)
+    ctx.call_on_close(ctx.obj.close)
+
+
+@cli.command("import-images")
+@click.argument("images", type=click.Path(exists=True), required=True)
+@click.option("--image-list", default=None, help="Path to image list or '-' for stdin")
+@click.option("--options", default=None)
+@click.pass_obj
+def import_images_cmd(db, images, image_list, options):
+    if image_list == "-":
+        image_list = [line.strip() for line in sys.stdin.readlines()]
+    elif image_list is not None:
+        with open(image_list) as f:
+            image_list = [line.strip() for line in f.readlines()]
+
+    if options is not None:
+        options = json.loads(options)
+
+    import_images(db, images, image_list, options)
+
+
+@cli.command("import-features")
+@click.argument("features", type=click.Path(exists=True), required=True)
+@click.pass_obj
+def import_features_cmd(db, features):
+    import_features(db, features)
+
+
+@cli.command("import-matches")
+@click.argument("match_file", type=click.Path(exists=True), required=True)
+@click.option("-p", "--pairs", type=click.Path(exists=True), required=True)
+@click.option("-nogv", "--skip-geometric-verification", is_flag=True, default=False)
+@click.option("-ms", "--min-match-score", type=float, default=None)
+@click.pass_obj
+def import_matches_cmd(
+    db, match_file, pairs, skip_geometric_verification, min_match_score
+):
+    import_matches(db, match_file, pairs, skip_geometric_verification, min_match_score)
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+
+import click
+import numpy as np
+
+from splats import (
+    SH_C0,
+    PlyFile,
+    PlyWriter,
+    bounds,
+    columns,
+    iter_ordered,
+    morton_order,
+    positions,
+    sigmoid,
+)
+
+# Splats sharing one set of quantization bounds
+SPLATS_PER_CHUNK = 256
+
+CHUNK = np.dtype(
+    [
+        (f"{kind}_{axis}", "<f4")
+        for kind in ("min", "max", "min_scale", "max_scale")
+        for axis in "xyz"
+    ]
+)
+
+VERTEX = np.dtype(
+    [
+        ("x", "<u2"),
+        ("y", "<u2"),
+        ("z", "<u2"),
+        ("rot", "<u4"),
+        ("scale_0", "u1"),
+        ("scale_1", "u1"),
+        ("scale_2", "u1"),
+        ("red", "u1"),
+        ("green", "u1"),
+        ("blue", "u1"),
+        ("opacity", "u1"),
+    ]
+)
+
+# Higher order SH coefficients are quantized from this range
+SH_RANGE = 4.0
+
+
+def quantize(values: np.ndarray, lo: np.ndarray, hi: np.ndarray, bits: int):
+    scale = (2**bits - 1) / np.maximum(hi - lo, 1e-12)
+    return np.clip(np.round((values - lo) * scale), 0, 2**bits - 1)
+
+
+def unit_to_u8(values: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(values * 255), 0, 255).astype(np.uint8)
+
+
+def pack_rotations(rotations: np.ndarray) -> np.ndarray:
+    """Smallest-three quaternion encoding in 2 + 3 x 10 bits
+
+    The largest component is dropped and restored from the unit norm,
+    the others lie within +-1/sqrt(2).
+    """
+    q = rotations / np.linalg.norm(rotations, axis=1, keepdims=True)
+    largest = np.abs(q).argmax(axis=1)
+    rows = np.arange(len(q))
+    q *= np.where(q[rows, largest] < 0, -1, 1)[:, None]
+
+    packed = largest.astype(np.uint32) << 30
+    others = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])[largest]
+    for i in range(3):
+        value = q[rows, others[:, i]] * np.sqrt(2) * 0.5 + 0.5
+        packed |= quantize(value, 0, 1, 10).astype(np.uint32) << (20 - 10 * i)
+    return packed
+
+
+def chunk_bounds(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    starts = np.arange(0, len(values), SPLATS_PER_CHUNK)
+    lo = np.minimum.reduceat(values, starts, axis=0)
+    hi = np.maximum.reduceat(values, starts, axis=0)
+    return lo, hi
+
+
+def export(ply: PlyFile, output: Path, sh_degree: int) -> int:
+    lo, hi = bounds(ply)
+    order = morton_order(ply, lo, hi)
+
+    scale_names = ply.properties(r"scale_\d+")
+    rot_names = ply.properties(r"rot_\d+")
+    dc_names = ply.properties(r"f_dc_\d+")
+
+    # f_rest holds all coefficients of red, then green, then blue
+    rest_names = ply.properties(r"f_rest_\d+")
+    src_coeffs = len(rest_names) // 3
+    num_coeffs = (min(sh_degree, ply.sh_degree()) + 1) ** 2 - 1
+    sh_names = [
+        rest_names[c * src_coeffs + j] for c in range(3) for j in range(num_coeffs)
+    ]
+    sh = np.dtype([(f"f_rest_{i}", "u1") for i in range(len(sh_names))])
+
+    num_chunks = -(-len(ply) // SPLATS_PER_CHUNK)
+    elements = {"chunk": (CHUNK, num_chunks), "vertex": (VERTEX, len(ply))}
+    if sh_names:
+        elements["sh"] = (sh, len(ply))
+
+    with PlyWriter(output, elements) as out:
+        for start, vertices in iter_ordered(ply, order):
+            end = start + len(vertices)
+            xyz = positions(vertices)
+            scales = columns(vertices, scale_names)
+
+            xyz_lo, xyz_hi = chunk_bounds(xyz)
+            scale_lo, scale_hi = chunk_bounds(scales)
+            first = start // SPLATS_PER_CHUNK
+            chunks = out["chunk"][first : first + len(xyz_lo)]
+            for i, axis in enumerate("xyz"):
+                chunks[f"min_{axis}"] = xyz_lo[:, i]
+                chunks[f"max_{axis}"] = xyz_hi[:, i]
+                chunks[f"min_scale_{axis}"] = scale_lo[:, i]
+                chunks[f"max_scale_{axis}"] = scale_hi[:, i]
+
+            # Bounds of the chunk each splat belongs to
+            owner = np.arange(len(vertices)) // SPLATS_PER_CHUNK
+            packed = out["vertex"][start:end]
+            xyz = quantize(xyz, xyz_lo[owner], xyz_hi[owner], 16)
+            scales = quantize(scales, scale_lo[owner], scale_hi[owner], 8)
+            colors = 0.5 + SH_C0 * columns(vertices, dc_names)
+            for i, axis in enumerate("xyz"):
+                packed[axis] = xyz[:, i]
+                packed[f"scale_{i}"] = scales[:, i]
+            for i, channel in enumerate(("red", "green", "blue")):
+                packed[channel] = unit_to_u8(colors[:, i])
+            packed["opacity"] = unit_to_u8(sigmoid(vertices["opacity"]))
+            packed["rot"] = pack_rotations(columns(vertices, rot_names))
+
+            if sh_names:
+                values = columns(vertices, sh_names) / (2 * SH_RANGE) + 0.5
+                out["sh"][start:end] = unit_to_u8(values).view(sh).reshape(-1)
+
+    return output.stat().st_size
+
+
+@click.command()
+@click.argument("model", type=click.Path(exists=True, dir_okay=False))
+@click.option("-o", "--output", required=True)
+@click.option(
+    "--sh-degree",
+    type=click.IntRange(0, 3),
+    default=3,
+    help="Truncate spherical harmonics to this degree",
+)
+def cli(model, output, sh_degree):
+    ply = PlyFile(model)
+    if len(ply) == 0:
+        raise ValueError(f"{model} has no splats")
+    size = export(ply, Path(output), sh_degree)
+
+    original = Path(model).stat().st_size
+    print(
+        f"Exported {len(ply)} splats: {original / 2**20:.1f} MiB -> "
+        f"{size / 2**20:.1f} MiB ({original / size:.1f}x smaller)"
+    )
+
+
+if __name__ == "__main__":
+    cli()
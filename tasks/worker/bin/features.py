@@ -3,9 +3,15 @@
 import os
 import json
 import logging
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
 from pathlib import Path
 from subprocess import run
 import click
+import h5py
 import torch
 
 
@@ -44,6 +50,12 @@ torch.hub.tqdm = QuietTqdm
 from hloc.extract_features import main as hloc_extract_features
 from hloc.match_features import match_from_paths as hloc_match_features
 
+from hloc.utils.io import find_pair
+
+from cache import FeatureCache, MatchCache, copy_group
+from database import open_database, import_images, import_features, import_matches
+from pairing import shard_paths, write_pairs
+
 
 def get_feature_config(feature_type: dict, out: Path):
     output = {"output": out.stem}
@@ -138,6 +150,108 @@ def colmap_match_features(pairs: Path, database: Path):
     run(cmd, check=True, capture_output=True)
 
 
+def init_cpu_worker(threads: int):
+    # Must run before CUDA is initialized in the worker
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    torch.set_num_threads(threads)
+
+
+def match_shard(matcher_config: dict, pairs: Path, matches: Path, features: Path):
+    # hloc resumes from the pairs already in matches, so retries are cheap
+    hloc_match_features(matcher_config, pairs, matches, features, features)
+    return pairs, matches
+
+
+def merge_matches(src: Path, dst: Path, pairs: list[tuple[str, str]]):
+    with h5py.File(src, "r") as fs, h5py.File(dst, "a") as fd:
+        for name0, name1 in pairs:
+            pair, _ = find_pair(fs, name0, name1)
+            if pair not in fd:
+                copy_group(fs[pair], fd, pair)
+
+
+def read_pairs(pairs: Path) -> list[tuple[str, str]]:
+    with open(pairs) as f:
+        return [tuple(line.split()) for line in f if line.strip()]
+
+
+def hloc_match_sharded(
+    matcher_config: dict,
+    pairs: list[tuple[str, str]],
+    matches: Path,
+    features: Path,
+    cache: MatchCache,
+    hashes: dict[str, str],
+    workers: int,
+    threads: int,
+    retries: int,
+):
+    shard_dir = matches.parent / f"{matches.stem}-shards"
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    shard_dir.mkdir()
+
+    write_pairs(pairs, shard_dir / "pairs.txt", shards=workers)
+    shards = [
+        p for p in shard_paths(shard_dir / "pairs.txt", workers) if p.stat().st_size
+    ]
+
+    context = multiprocessing.get_context("spawn")
+    attempts = {shard: 0 for shard in shards}
+    remaining = shards
+    while remaining:
+        with ProcessPoolExecutor(
+            workers,
+            mp_context=context,
+            initializer=init_cpu_worker,
+            initargs=(threads,),
+        ) as pool:
+
+            def submit(shard: Path):
+                attempts[shard] += 1
+                future = pool.submit(
+                    match_shard,
+                    matcher_config,
+                    shard,
+                    shard.with_suffix(".h5"),
+                    features,
+                )
+                pending[future] = shard
+
+            pending = {}
+            for shard in remaining:
+                submit(shard)
+
+            remaining = []
+            while pending:
+                future = next(as_completed(pending))
+                shard = pending.pop(future)
+                try:
+                    shard_pairs, shard_matches = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died, e.g. to the OOM killer, and took every
+                    # shard in flight with it, restart them in a new pool
+                    remaining = [shard, *pending.values()]
+                    if any(attempts[s] > retries for s in remaining):
+                        raise
+                    logging.warning("Restarting %d shards after: %s", len(remaining), e)
+                    break
+                except Exception as e:
+                    if attempts[shard] > retries:
+                        raise
+                    logging.warning("Retrying shard %s after error: %s", shard.name, e)
+                    submit(shard)
+                    continue
+
+                # Cache finished shards right away, a rerun after a failure
+                # only has to match the shards that did not finish
+                shard_pairs = read_pairs(shard_pairs)
+                merge_matches(shard_matches, matches, shard_pairs)
+                cache.store(matches, hashes, shard_pairs)
+                print(f"Matched shard {shard.name} ({len(shard_pairs)} pairs)")
+
+    shutil.rmtree(shard_dir)
+
+
 @click.group()
 def cli():
     os.environ["TQDM_DISABLE"] = "1"
@@ -161,37 +275,54 @@ def extract(config, images, features, database):
 
     if feature_config["model"]["name"] == "colmap":
         logging.info("Extracting features with colmap")
+        database.unlink(missing_ok=True)
         colmap_extract_features(images, database)
     else:
-        logging.info("Extracting features with hloc")
-        hloc_extract_features(feature_config, images, features.parent)
+        cache = FeatureCache(feature_config)
+        hashes, misses = cache.assemble(images, features)
+
+        if misses:
+            logging.info("Extracting features with hloc")
+            hloc_extract_features(
+                feature_config,
+                images,
+                features.parent,
+                image_list=misses,
+                feature_path=features,
+            )
+            cache.store(features, hashes, misses)
+            cache.evict()
 
-        logging.info("Writing images to database")
-        run(
-            ["database.py", "--overwrite", str(database), "import-images", str(images)],
-            check=True,
-        )
+        with closing(open_database(str(database), overwrite=True)) as db:
+            logging.info("Writing images to database")
+            import_images(db, images)
 
-        logging.info("Writing features to database")
-        run(
-            ["database.py", str(database), "import-features", str(features)], check=True
-        )
+            logging.info("Writing features to database")
+            import_features(db, features)
 
 
 @cli.command()
 @click.option("-c", "--config", required=True)
 @click.option("-p", "--pairs", type=click.Path(exists=True))
+@click.option("-i", "--images", type=click.Path(exists=True), default="images")
 @click.option("-f", "--features", type=click.Path(), default="features.h5")
 @click.option("-m", "--matches", type=click.Path(), default="matches.h5")
 @click.option("-d", "--database", type=click.Path(), default="database.db")
-def match(config, pairs, features, matches, database):
+@click.option("-j", "--workers", type=int, default=1, help="Match shards on CPU")
+@click.option("-t", "--threads", type=int, default=None, help="Torch threads/worker")
+@click.option("-r", "--retries", type=int, default=1, help="Retries per shard")
+def match(
+    config, pairs, images, features, matches, database, workers, threads, retries
+):
     pairs = Path(pairs)
+    images = Path(images)
     features = Path(features)
     matches = Path(matches)
 
     config = json.loads(config)
     try:
         matcher_config = get_matcher_config(config["matching"], matches)
+        feature_config = get_feature_config(config["matching"]["features"], features)
     except KeyError as e:
         raise ValueError(f"Invalid config: {e}")
 
@@ -199,23 +330,36 @@ def match(config, pairs, features, matches, database):
         logging.info("Matching features with colmap")
         colmap_match_features(pairs, database)
     else:
-        logging.info("Matching features with hloc")
-        hloc_match_features(matcher_config, pairs, matches, features, features)
+        cache = MatchCache(matcher_config, feature_config)
+        hashes, misses = cache.assemble(images, features, pairs, matches)
+
+        if misses and workers > 1:
+            logging.info("Matching features with hloc in %d shards", workers)
+            hloc_match_sharded(
+                matcher_config,
+                misses,
+                matches,
+                features,
+                cache,
+                hashes,
+                workers,
+                threads or max(1, os.cpu_count() // workers),
+                retries,
+            )
+        elif misses:
+            # hloc skips the pairs that are already in matches.h5
+            logging.info("Matching features with hloc")
+            hloc_match_features(matcher_config, pairs, matches, features, features)
+            cache.store(matches, hashes, misses)
+
+        if misses:
+            cache.evict()
 
         min_match_score = config["matching"].get("minMatchScore", None)
 
-        cmd = [
-            "database.py",
-            str(database),
-            "import-matches",
-            str(matches),
-            "-p",
-            str(pairs),
-        ]
-        if min_match_score is not None:
-            cmd += ["--min-match-score", str(min_match_score)]
-
-        run(cmd, check=True)
+        logging.info("Writing matches to database")
+        with closing(open_database(str(database))) as db:
+            import_matches(db, matches, pairs, min_match_score=min_match_score)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import json
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+import click
+
+from colmap_model import Model
+
+STATS_FILE = "stats.jsonl"
+REPORT_FILE = "report.json"
+
+# Files written by stages that are not named after their output
+OUTPUTS = {
+    "features": ["features.h5", "features.db"],
+    "database.db": ["database.db", "matches.h5"],
+}
+
+
+def path_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def output_size(stage: str) -> int:
+    paths = [Path(output) for output in OUTPUTS.get(stage, [stage])]
+    return sum(path_size(path) for path in paths if path.exists())
+
+
+def count_files(path: Path) -> int:
+    return sum(1 for p in path.iterdir() if p.is_file())
+
+
+def count_lines(path: Path) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def query_database(database: Path, query: str) -> tuple:
+    with sqlite3.connect(f"file:{database}?mode=ro", uri=True) as db:
+        return db.execute(query).fetchone()
+
+
+def measure(stage: str) -> dict[str, Any]:
+    metrics = {}
+
+    if stage == "uploads":
+        metrics["uploads"] = count_files(Path("uploads"))
+    elif stage == "images":
+        metrics["images"] = count_files(Path("images"))
+    elif stage == "pairs.txt":
+        metrics["pairs"] = count_lines(Path("pairs.txt"))
+    elif stage == "features":
+        images, keypoints = query_database(
+            Path("features.db"), "SELECT count(*), sum(rows) FROM keypoints;"
+        )
+        metrics |= {"images": images, "keypoints": keypoints or 0}
+    elif stage == "database.db":
+        (pairs,) = query_database(
+            Path("database.db"), "SELECT count(*) FROM matches WHERE rows > 0;"
+        )
+        (verified,) = query_database(
+            Path("database.db"),
+            "SELECT count(*) FROM two_view_geometries WHERE rows > 0;",
+        )
+        metrics |= {"matchedPairs": pairs, "verifiedPairs": verified}
+    elif stage == "distorted/sparse/0" and Path(stage, "images.bin").exists():
+        # Only after select_largest_model.py has picked the model
+        stats = Model(stage).stats()
+        metrics |= {
+            key: stats[key]
+            for key in (
+                "registeredImages",
+                "points",
+                "meanTrackLength",
+                "meanReprojectionError",
+            )
+        }
+    elif stage == "undistorted":
+        metrics["images"] = count_files(Path("undistorted/images"))
+
+    return metrics
+
+
+def aggregate(records: list[dict[str, Any]]) -> dict[str, Any]:
+    # A stage may run several instrumented commands
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(
+            record["stage"], {"wallTime": 0.0, "cpuTime": 0.0, "peakRss": 0}
+        )
+        stage["wallTime"] += record["wallTime"]
+        stage["cpuTime"] += record["cpuTime"]
+        stage["peakRss"] = max(stage["peakRss"], record["peakRss"])
+        stage |= record["metrics"]
+        stage["outputBytes"] = record["outputBytes"]
+        stage["returncode"] = record["returncode"]
+
+    return {
+        "stages": stages,
+        "wallTime": sum(s["wallTime"] for s in stages.values()),
+        "cpuTime": sum(s["cpuTime"] for s in stages.values()),
+        "peakRss": max((s["peakRss"] for s in stages.values()), default=0),
+    }
+
+
+def load_report(workdir: Path) -> dict[str, Any]:
+    stats = Path(workdir) / STATS_FILE
+    if not stats.exists():
+        return aggregate([])
+
+    with open(stats) as f:
+        return aggregate([json.loads(line) for line in f if line.strip()])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(context_settings={"allow_interspersed_args": False})
+@click.argument("stage")
+@click.argument("cmd", nargs=-1, type=click.UNPROCESSED, required=True)
+def run(stage, cmd):
+    """Run CMD and record its resource usage as STAGE"""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+
+    returncode = subprocess.call(cmd)
+
+    wall_time = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    record = {
+        "stage": stage,
+        "command": cmd[0],
+        "returncode": returncode,
+        "wallTime": round(wall_time, 3),
+        "cpuTime": round(
+            after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime, 3
+        ),
+        # Linux reports kilobytes
+        "peakRss": after.ru_maxrss * 1024,
+        "outputBytes": output_size(stage),
+        "metrics": {},
+    }
+    if returncode == 0:
+        try:
+            record["metrics"] = measure(stage)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Could not measure {stage}: {e}", file=sys.stderr)
+
+    with open(STATS_FILE, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    sys.exit(returncode)
+
+
+@cli.command()
+@click.option("-o", "--output", default=REPORT_FILE)
+def report(output):
+    """Aggregate the recorded stages into a JSON report"""
+    with open(output, "w") as f:
+        json.dump(load_report(Path.cwd()), f, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
@@ -2,51 +2,252 @@
 
 import click
 import json
-from itertools import combinations
+import re
+from array import array
+from collections import defaultdict
+from contextlib import ExitStack
+from itertools import chain, combinations
 from pathlib import Path
-from hloc import extract_features, pairs_from_retrieval
+from typing import Iterator
+import h5py
+import numpy as np
+from hloc import extract_features
+
+from cache import DescriptorCache, hash_files
+
+# Maximum number of similarity scores computed at once
+SIMILARITY_BLOCK = 2**24
+
+# Video frames are named {stem}_{num:05d} by process_uploads.py
+FRAME_NAME = re.compile(r"^(?P<source>.+)_(?P<frame>\d{5,})$")
 
 
 def pair_exhaustive(images):
     return combinations(images, r=2)
 
 
+def group_by_source(images: list[str]) -> tuple[dict[str, list], list[str]]:
+    videos = defaultdict(list)
+    for name in images:
+        match = FRAME_NAME.match(Path(name).stem)
+        if match is not None:
+            videos[match["source"]].append((int(match["frame"]), name))
+
+    # Photos can be named like frames too, e.g. IMG_20231122_123456.jpg,
+    # a lone "frame" is paired as a photo rather than dropped
+    videos = {source: sorted(frames) for source, frames in videos.items()}
+    videos = {source: frames for source, frames in videos.items() if len(frames) > 1}
+    framed = {name for frames in videos.values() for _, name in frames}
+    return videos, [name for name in images if name not in framed]
+
+
 def pair_sequential(images, num):
+    if num < 1:
+        return []
+
+    videos, photos = group_by_source(images)
+
     pairs = []
+    for frames in videos.values():
+        # Window in frame time, num times the typical extraction stride,
+        # so that gaps from dropped frames do not pull in distant frames
+        stride = np.median(np.diff([frame for frame, _ in frames]))
+        window = num * max(stride, 1)
+
+        for i, (frame, name) in enumerate(frames):
+            for j in range(i + 1, len(frames)):
+                # Always keep the next frame so that the clip stays connected
+                if j > i + 1 and frames[j][0] - frame > window:
+                    break
+                pairs.append((name, frames[j][1]))
+
     for i in range(1, num + 1):
-        pairs.extend(list(zip(images, images[i:])))
+        pairs.extend(list(zip(photos, photos[i:])))
     return pairs
 
 
-def pair_retrieval(images: str, out_features: str, out_pairs: str, num_matched: int):
+def get_global_descriptors(
+    image_dir: Path, images: list[str], out_features: Path
+) -> np.ndarray:
     retrieval_conf = extract_features.confs["netvlad"]
-    retrieval_path = extract_features.main(
-        retrieval_conf, Path(images), Path(out_features)
+    cache = DescriptorCache(retrieval_conf)
+
+    hashes = dict(zip(images, hash_files(image_dir / name for name in images)))
+    cached = cache.keys()
+    missing = [name for name in images if hashes[name] not in cached]
+    print(f"Descriptor cache: {len(images) - len(missing)} hits, {len(missing)} misses")
+
+    if missing:
+        out_features.unlink(missing_ok=True)
+        extract_features.main(
+            retrieval_conf, image_dir, image_list=missing, feature_path=out_features
+        )
+        with h5py.File(out_features, "r") as f:
+            descriptors = [f[name]["global_descriptor"].__array__() for name in missing]
+        cache.append([hashes[name] for name in missing], np.stack(descriptors))
+
+    return cache.load([hashes[name] for name in images])
+
+
+def retrieval_pairs(
+    descriptors: np.ndarray, images: list[str], num_matched: int
+) -> Iterator[tuple[str, str]]:
+    # Same selection as hloc.pairs_from_retrieval, but computed in row
+    # blocks so that the full similarity matrix is never held in memory
+    num_images = len(images)
+    num_matched = min(num_matched, num_images)
+    block_size = max(1, SIMILARITY_BLOCK // num_images)
+
+    for start in range(0, num_images, block_size):
+        stop = min(start + block_size, num_images)
+        rows = np.arange(stop - start)
+
+        scores = descriptors[start:stop] @ descriptors.T
+        scores[rows, rows + start] = -np.inf
+        scores[scores < 0] = -np.inf
+
+        top = np.argpartition(-scores, num_matched - 1, axis=1)[:, :num_matched]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        for i, j in zip(*np.nonzero(np.isfinite(top_scores))):
+            yield images[start + i], images[top[i, j]]
+
+
+def pair_retrieval(
+    image_dir: Path,
+    images: list[str],
+    out_features: Path,
+    out_pairs: str,
+    num_matched: int,
+):
+    descriptors = get_global_descriptors(image_dir, images, out_features)
+    write_pairs(retrieval_pairs(descriptors, images, num_matched), out_pairs)
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> bool:
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return False
+        self.parent[max(root_i, root_j)] = min(root_i, root_j)
+        return True
+
+
+def pair_budget(
+    images: list[str],
+    descriptors: np.ndarray,
+    budget: int,
+    num_seq: int = 1,
+    num_retr: int = 0,
+) -> list[tuple[str, str]]:
+    num_images = len(images)
+    index = {name: i for i, name in enumerate(images)}
+
+    # Candidates are sequential neighbours and enough retrieval
+    # neighbours per image to fill the budget
+    num_retr = max(num_retr, -(-2 * budget // max(num_images, 1)))
+    candidates = {
+        (min(index[i], index[j]), max(index[i], index[j]))
+        for i, j in chain(
+            pair_sequential(images, num_seq),
+            retrieval_pairs(descriptors, images, num_retr),
+        )
+    }
+    edges = np.array(sorted(candidates), dtype=np.int64).reshape(-1, 2)
+    scores = np.einsum("ij,ij->i", descriptors[edges[:, 0]], descriptors[edges[:, 1]])
+    edges = edges[np.argsort(-scores, kind="stable")]
+
+    # Maximum spanning forest over the similarity of the candidates
+    components = UnionFind(num_images)
+    backbone = [components.union(i, j) for i, j in edges]
+    selected = {(i, j) for (i, j), tree in zip(edges.tolist(), backbone) if tree}
+
+    # Chain the remaining components in frame order, the graph is connected
+    for i in range(num_images - 1):
+        if components.union(i, i + 1):
+            selected.add((i, i + 1))
+
+    num_backbone = len(selected)
+    for i, j in edges.tolist():
+        if len(selected) >= budget:
+            break
+        selected.add((i, j))
+
+    print(
+        f"Expecting {len(selected)} matching operations for a budget of "
+        f"{budget} ({num_backbone} backbone pairs), exhaustive would be "
+        f"{num_images * (num_images - 1) // 2}"
     )
-    pairs_from_retrieval.main(retrieval_path, out_pairs, num_matched=num_matched)
+    if num_backbone > budget:
+        print(f"Budget is too small to connect {num_images} images")
+
+    return [(images[i], images[j]) for i, j in sorted(selected)]
 
 
-def pair_merge(pair_paths):
-    pairs = set()
+def pair_merge(pair_paths, images: list[str]) -> Iterator[tuple[str, str]]:
+    # Pairs are deduplicated as sorted integer keys, in either orientation
+    num_images = len(images)
+    index = {name: i for i, name in enumerate(images)}
+
+    keys = array("q")
     for pair_path in pair_paths:
         pair_path = Path(pair_path)
         if pair_path.exists():
             with pair_path.open() as f:
-                pairs |= {tuple(p.split()) for p in f.readlines()}
+                for line in f:
+                    if line.strip():
+                        i, j = sorted(index[name] for name in line.split())
+                        keys.append(i * num_images + j)
+
+    for key in np.unique(np.frombuffer(keys, dtype=np.int64)).tolist():
+        i, j = divmod(key, num_images)
+        yield images[i], images[j]
 
-    return list(sorted(pairs))
 
+def shard_paths(output: Path, shards: int) -> list[Path]:
+    output = Path(output)
+    return [
+        output.with_name(f"{output.stem}-{k:03d}{output.suffix}") for k in range(shards)
+    ]
 
-def write_pairs(pairs, output):
-    with open(output, "w") as f:
-        f.write("\n".join(" ".join([i, j]) for i, j in pairs))
+
+def write_pairs(pairs, output, shards: int = 0) -> int:
+    # Pairs are streamed to disk, shards get every n-th pair
+    num_pairs = 0
+    with ExitStack() as stack:
+        f = stack.enter_context(open(output, "w"))
+        shard_files = [
+            stack.enter_context(open(path, "w")) for path in shard_paths(output, shards)
+        ]
+        for i, j in pairs:
+            line = f"{i} {j}\n"
+            f.write(line)
+            if shard_files:
+                shard_files[num_pairs % shards].write(line)
+            num_pairs += 1
+    return num_pairs
 
 
 @click.command()
 @click.option("-i", "--image_dir", type=click.Path(exists=True))
 @click.option("-c", "--config", type=str)
 @click.option("-o", "--output", type=click.Path())
-def pairing(image_dir, config, output):
+@click.option(
+    "-s", "--shards", type=int, default=0, help="Also split pairs into shard files"
+)
+def pairing(image_dir, config, output, shards):
     images = [p.name for p in Path(image_dir).iterdir()]
     images.sort()
 
@@ -55,29 +256,48 @@ def pairing(image_dir, config, output):
 
     if pairing_type == "exhaustive":
         pairs = pair_exhaustive(images)
-        write_pairs(pairs, output)
 
     elif pairing_type == "complex":
+        # Only merge files from this run, not leftovers of a previous config
+        pair_paths = []
+
         num_seq = config.get("sequential", 0)
         if num_seq:
             seq_pairs = pair_sequential(images, num_seq)
             write_pairs(seq_pairs, "seq_pairs.txt")
+            pair_paths.append("seq_pairs.txt")
 
         num_retr = config.get("retrieval", 0)
         if num_retr:
             pair_retrieval(
-                image_dir,
-                "retrieval.h5",
+                Path(image_dir),
+                images,
+                Path("retrieval.h5"),
                 "retr_pairs.txt",
-                config.get("retrieval", 0),
+                num_retr,
             )
+            pair_paths.append("retr_pairs.txt")
 
-        pairs = pair_merge(["seq_pairs.txt", "retr_pairs.txt"])
-        write_pairs(pairs, output)
+        pairs = pair_merge(pair_paths, images)
+
+    elif pairing_type == "budget":
+        descriptors = get_global_descriptors(
+            Path(image_dir), images, Path("retrieval.h5")
+        )
+        pairs = pair_budget(
+            images,
+            descriptors,
+            int(config["budget"]),
+            config.get("sequential", 1),
+            config.get("retrieval", 0),
+        )
 
     else:
         raise ValueError(f"Unknown pairing type: {pairing_type}")
 
+    num_pairs = write_pairs(pairs, output, shards)
+    print(f"Wrote {num_pairs} pairs")
+
 
 if __name__ == "__main__":
     pairing()
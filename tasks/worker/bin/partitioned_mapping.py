@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Optional
+
+import click
+import networkx as nx
+import pycolmap
+from hloc.utils.database import MAX_IMAGE_ID
+from networkx.algorithms.community import kernighan_lin_bisection
+
+from colmap_model import Model
+
+# Connected components below this size cannot be reconstructed
+MIN_CLUSTER_SIZE = 3
+
+# Registered images two submodels must share to be aligned
+MIN_SHARED_IMAGES = 3
+
+
+def read_match_graph(database: Path, min_inliers: int) -> nx.Graph:
+    """Images connected by their geometrically verified pairs"""
+    with sqlite3.connect(f"file:{database}?mode=ro", uri=True) as db:
+        names = dict(db.execute("SELECT image_id, name FROM images;"))
+        rows = db.execute(
+            "SELECT pair_id, rows FROM two_view_geometries WHERE rows >= ?;",
+            (min_inliers,),
+        ).fetchall()
+
+    graph = nx.Graph()
+    graph.add_nodes_from(names.values())
+    for pair_id, inliers in rows:
+        image_id1, image_id2 = divmod(pair_id, MAX_IMAGE_ID)
+        graph.add_edge(names[image_id1], names[image_id2], weight=inliers)
+    return graph
+
+
+def bfs_halves(graph: nx.Graph) -> tuple[set[str], set[str]]:
+    """Split in breadth-first order from a peripheral image
+
+    A good starting point for Kernighan-Lin, which only refines locally.
+    Walk-throughs are chains, which this already cuts in the middle.
+    """
+    start = next(iter(graph))
+    for _ in range(2):
+        *_, start = nx.bfs_tree(graph, start)
+
+    order = list(nx.bfs_tree(graph, start))
+    # Disconnected leftovers of an earlier split go last
+    reached = set(order)
+    order += [node for node in graph if node not in reached]
+    return set(order[: len(order) // 2]), set(order[len(order) // 2 :])
+
+
+def partition(graph: nx.Graph, max_size: int, seed: int = 0) -> list[set[str]]:
+    """Recursive Kernighan-Lin bisection, cutting as few inliers as possible"""
+    stack = [
+        set(nodes)
+        for nodes in nx.connected_components(graph)
+        if len(nodes) >= MIN_CLUSTER_SIZE
+    ]
+
+    clusters = []
+    while stack:
+        nodes = stack.pop()
+        if len(nodes) <= max_size:
+            clusters.append(nodes)
+        else:
+            subgraph = graph.subgraph(nodes)
+            halves = kernighan_lin_bisection(
+                subgraph, bfs_halves(subgraph), weight="weight", seed=seed
+            )
+            stack.extend(halves)
+    return clusters
+
+
+def expand(graph: nx.Graph, cluster: set[str], overlap: float) -> set[str]:
+    """Add outside images ring by ring until the overlap is reached
+
+    Within a ring the images most strongly connected to the previous ring
+    come first. Chains, like walk-throughs, have a single image per ring.
+    """
+    num = max(MIN_SHARED_IMAGES, round(overlap * len(cluster)))
+    expanded, ring = set(cluster), cluster
+    while len(expanded) < len(cluster) + num:
+        scores = defaultdict(int)
+        for node in ring:
+            for neighbor, edge in graph[node].items():
+                if neighbor not in expanded:
+                    scores[neighbor] += edge["weight"]
+        if not scores:
+            break
+
+        missing = len(cluster) + num - len(expanded)
+        ring = sorted(scores, key=scores.get, reverse=True)[:missing]
+        expanded.update(ring)
+    return expanded
+
+
+def map_cluster(
+    database: Path, images: Path, output: Path, names: list[str], threads: int
+) -> Optional[Path]:
+    output.mkdir(parents=True, exist_ok=True)
+    options = {
+        "image_names": names,
+        "num_threads": threads,
+        "ba_global_function_tolerance": 1e-6,
+    }
+    with pycolmap.ostream():
+        reconstructions = pycolmap.incremental_mapping(
+            str(database), str(images), str(output), options=options
+        )
+    if not reconstructions:
+        return None
+
+    best = max(reconstructions.values(), key=lambda r: r.num_reg_images())
+    path = output / "model"
+    path.mkdir(exist_ok=True)
+    best.write(str(path))
+    return path
+
+
+def model_merger(model1: Path, model2: Path, output: Path) -> bool:
+    shutil.rmtree(output, ignore_errors=True)
+    output.mkdir(parents=True)
+    subprocess.run(
+        [
+            "colmap",
+            "model_merger",
+            "--input_path1",
+            str(model1),
+            "--input_path2",
+            str(model2),
+            "--output_path",
+            str(output),
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    # COLMAP writes the first model unchanged when the alignment fails
+    return Model(output).num_images > Model(model1).num_images
+
+
+def merge_models(models: list[Path], output: Path, workdir: Path) -> list[Path]:
+    """Greedily merge submodels into the largest one through shared images
+
+    Submodels that cannot be aligned start a model of their own.
+    """
+    images = {model: set(Model(model).image_names) for model in models}
+    remaining = sorted(models, key=lambda m: len(images[m]), reverse=True)
+
+    merged_models = []
+    while remaining:
+        merged = output / str(len(merged_models))
+        shutil.copytree(remaining.pop(0), merged)
+        merged_images = set(Model(merged).image_names)
+
+        candidates = True
+        while candidates:
+            shared = {model: len(images[model] & merged_images) for model in remaining}
+            candidates = sorted(
+                (m for m in remaining if shared[m] >= MIN_SHARED_IMAGES),
+                key=shared.get,
+                reverse=True,
+            )
+
+            for model in candidates:
+                result = workdir / "merged"
+                if model_merger(merged, model, result):
+                    shutil.rmtree(merged)
+                    shutil.move(result, merged)
+                    merged_images = set(Model(merged).image_names)
+                    remaining.remove(model)
+                    print(f"Merged {model.parent.name}, {len(merged_images)} images")
+                    break
+            else:
+                candidates = []
+
+        merged_models.append(merged)
+    return merged_models
+
+
+@click.command()
+@click.option("-d", "--database", type=click.Path(exists=True), default="database.db")
+@click.option("-i", "--images", type=click.Path(exists=True), default="images")
+@click.option("-o", "--output", type=click.Path(), default="distorted/sparse")
+@click.option("-c", "--config", type=str, default="{}")
+@click.option("-w", "--workdir", type=click.Path(), default="distorted/partitions")
+@click.option("-j", "--workers", type=int, default=4)
+def cli(database, images, output, config, workdir, workers):
+    config = json.loads(config)
+    max_size = int(config.get("clusterSize", 300))
+    overlap = float(config.get("overlap", 0.2))
+    min_inliers = int(config.get("minInliers", 15))
+
+    graph = read_match_graph(Path(database), min_inliers)
+    clusters = [expand(graph, c, overlap) for c in partition(graph, max_size)]
+    print(
+        f"Partitioned {graph.number_of_nodes()} images into {len(clusters)} "
+        f"clusters of {', '.join(str(len(c)) for c in clusters)} images"
+    )
+
+    workdir = Path(workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    workers = max(1, min(workers, len(clusters)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as pool:
+        futures = [
+            pool.submit(
+                map_cluster,
+                Path(database),
+                Path(images),
+                workdir / f"cluster-{i:03d}",
+                sorted(cluster),
+                threads,
+            )
+            for i, cluster in enumerate(clusters)
+        ]
+        submodels = [model for future in futures if (model := future.result())]
+
+    for model in submodels:
+        print(f"Mapped {model.parent.name}: {Model(model).num_images} images")
+
+    # Models of an earlier run would be picked up by select_largest_model.py
+    output = Path(output)
+    shutil.rmtree(output, ignore_errors=True)
+    output.mkdir(parents=True)
+    merged = merge_models(submodels, output, workdir)
+    print(f"Merged {len(submodels)} submodels into {len(merged)} models")
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    cli()
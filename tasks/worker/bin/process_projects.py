@@ -1,38 +1,97 @@
 #!/usr/bin/env python3
+import json
 import os
 from pathlib import Path
 from enum import Enum
+import queue
+import select
+import signal
 import subprocess
-from typing import Iterator, Literal
+import threading
+import time
+from typing import Iterator, Literal, Optional
 import logging
 
 
 import click
 import psycopg
-from psycopg.sql import SQL
+from psycopg import sql
+from psycopg.sql import SQL, Identifier
+from psycopg.types.json import Jsonb
+
+from instrument import STATS_FILE, load_report
+
+# Seconds between lease renewals of a running project, --lease must be longer
+HEARTBEAT_INTERVAL = 30
 
 
 class ProjectState(Enum):
     PENDING = 'PENDING'
     RUNNING = 'RUNNING'
     FAILED = 'FAILED'
-    SUCCESS = 'SUCCESS'
+    COMPLETE = 'COMPLETE'
     
 class Projects:
     fetch_query = SQL(
         """
         SELECT id::text, config::text
         FROM api.projects
-        WHERE state = 'pending'
+        WHERE state = %s
         ORDER BY created ASC
         LIMIT 1
         FOR UPDATE SKIP LOCKED;
         """
     )
+    claim_query = SQL(
+        """
+        UPDATE api.projects SET state = %(running)s, updated = now()
+        WHERE id = (
+            SELECT id FROM api.projects
+            WHERE state = %(pending)s
+            ORDER BY created ASC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id::text, config::text;
+        """
+    )
+    heartbeat_query = SQL(
+        "UPDATE api.projects SET updated = now() WHERE id = %s AND state = %s;"
+    )
+    requeue_query = SQL(
+        """
+        UPDATE api.projects SET state = %(pending)s
+        WHERE state = %(running)s
+          AND updated < now() - make_interval(secs => %(lease)s)
+        RETURNING id::text;
+        """
+    )
     get_query = SQL("SELECT config::text FROM api.projects WHERE id = %s;")
     update_query = SQL("UPDATE api.projects SET state = %s WHERE id = %s;")
+    stats_query = SQL("UPDATE api.projects SET stats = %s WHERE id = %s;")
     log_query = SQL("SELECT api.append_log_entry(%s, %s);")
 
+    # Channel for `NOTIFY projects` when a project becomes pending
+    channel = "projects"
+
+    # Sends the notification for every insert or state update to pending
+    notify_trigger = SQL(
+        """
+        CREATE OR REPLACE FUNCTION api.notify_pending_project() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify({channel}, NEW.id::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS notify_pending_project ON api.projects;
+        CREATE TRIGGER notify_pending_project
+        AFTER INSERT OR UPDATE OF state ON api.projects
+        FOR EACH ROW WHEN (NEW.state = {pending})
+        EXECUTE FUNCTION api.notify_pending_project();
+        """
+    )
+
     def __init__(self, db_uri):
         self.conn = psycopg.connect(db_uri)
         self.conn.autocommit = True
@@ -40,7 +99,7 @@ class Projects:
 
     def __iter__(self) -> Iterator[tuple[str, str]]:
         while True:
-            self.cursor.execute(self.fetch_query)
+            self.cursor.execute(self.fetch_query, (ProjectState.PENDING,))
             project = self.cursor.fetchone()
 
             if project is None:
@@ -48,6 +107,64 @@ class Projects:
 
             yield project
 
+    def claim(self) -> Optional[tuple[str, str]]:
+        self.cursor.execute(
+            self.claim_query,
+            {"running": ProjectState.RUNNING, "pending": ProjectState.PENDING},
+        )
+        return self.cursor.fetchone()
+
+    def heartbeat(self, project_id: str, cursor=None):
+        cursor = cursor or self.cursor
+        cursor.execute(self.heartbeat_query, (project_id, ProjectState.RUNNING))
+
+    def requeue_stale(self, lease: float) -> list[str]:
+        self.cursor.execute(
+            self.requeue_query,
+            {
+                "running": ProjectState.RUNNING,
+                "pending": ProjectState.PENDING,
+                "lease": lease,
+            },
+        )
+        return [project_id for project_id, in self.cursor.fetchall()]
+
+    def create_notify_trigger(self):
+        query = self.notify_trigger.format(
+            channel=sql.Literal(self.channel),
+            pending=sql.Literal(ProjectState.PENDING.name),
+        )
+        with self.conn.transaction():
+            self.cursor.execute(query)
+
+    def listen(self):
+        # Without the trigger the daemon still picks up projects when polling
+        try:
+            self.create_notify_trigger()
+        except psycopg.Error as e:
+            logging.warning("Could not create the notify trigger: %s", e)
+
+        self.notified = False
+        self.conn.add_notify_handler(self._on_notify)
+        self.cursor.execute(SQL("LISTEN {};").format(Identifier(self.channel)))
+
+    def _on_notify(self, notify: psycopg.Notify):
+        self.notified = True
+
+    def wait(self, timeout: float, *fds: int) -> list[int]:
+        # Notifications received by other queries, e.g. while claiming,
+        # are not seen by select, the caller has to claim again right away
+        if self.notified:
+            self.notified = False
+            return []
+
+        ready, _, _ = select.select([self.conn.fileno(), *fds], [], [], timeout)
+        if self.conn.fileno() in ready:
+            # Running any query consumes the pending notifications
+            self.cursor.execute("SELECT 1;")
+            self.notified = False
+        return ready
+
     def get_project(self, project_id: str) -> tuple[str, str]:
         self.cursor.execute(self.get_query, (project_id,))
         config = self.cursor.fetchone()[0]
@@ -60,9 +177,17 @@ class Projects:
     ):
         self.cursor.execute(self.update_query, (state, project_id))
 
+    def update_stats(self, project_id: str, stats: dict):
+        self.cursor.execute(self.stats_query, (Jsonb(stats), project_id))
+
     def append_log_entry(self, project_id: str, message: str):
         self.cursor.execute(self.log_query, (project_id, message))
 
+    def append_log_entries(self, project_id: str, messages: list[str], cursor=None):
+        # executemany is pipelined, the whole batch costs one round trip
+        cursor = cursor or self.cursor
+        cursor.executemany(self.log_query, [(project_id, m) for m in messages])
+
     def __enter__(self):
         return self
 
@@ -77,6 +202,10 @@ class MakeProcess:
 
         workdir = Path.cwd() / project_id
         workdir.mkdir(exist_ok=True)
+        self.workdir = workdir
+
+        # Stats of an earlier run in the same workdir would be reported again
+        (workdir / STATS_FILE).unlink(missing_ok=True)
 
         cmd = f"make -f {makefile}"
         env = os.environ | {"PROJECT_ID": project_id, "CONFIG": config}
@@ -102,16 +231,144 @@ class MakeProcess:
                 yield line
 
 
+class LogShipper:
+    """Ships log lines of a project in batches from a background thread
+
+    Lines are sent when `batch_size` lines are queued or `interval` seconds
+    have passed. When more than `max_queued` lines are waiting, new lines
+    are dropped and replaced by a single notice, order is preserved.
+    """
+
+    _stop = object()
+
+    def __init__(
+        self,
+        projects: Projects,
+        project_id: str,
+        batch_size: int = 200,
+        interval: float = 1.0,
+        max_queued: int = 10000,
+    ):
+        self.projects = projects
+        self.project_id = project_id
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.queue = queue.Queue(max_queued)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, line: str):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(f"[{self.dropped} log lines dropped]")
+                self.dropped = 0
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _next_batch(self) -> tuple[list[str], bool]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size and batch[-1] is not self._stop:
+            try:
+                batch.append(self.queue.get(timeout=deadline - time.monotonic()))
+            except (queue.Empty, ValueError):
+                break
+
+        if batch[-1] is self._stop:
+            return batch[:-1], True
+        return batch, False
+
+    def _run(self):
+        # Separate cursor, the connection itself is thread-safe
+        with self.projects.conn.cursor() as cursor:
+            stopped = False
+            while not stopped:
+                batch, stopped = self._next_batch()
+                if batch:
+                    try:
+                        self.projects.append_log_entries(self.project_id, batch, cursor)
+                    except psycopg.Error:
+                        logging.exception("Failed to ship %d log lines", len(batch))
+
+    def close(self):
+        if self.dropped:
+            self.queue.put(f"[{self.dropped} log lines dropped]")
+        self.queue.put(self._stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Heartbeat:
+    """Renews the lease of a running project from a background thread
+
+    Every run mode sends heartbeats, a daemon requeues running projects
+    whose lease expired no matter who started them.
+    """
+
+    def __init__(
+        self, projects: Projects, project_id: str, interval: float = HEARTBEAT_INTERVAL
+    ):
+        self.projects = projects
+        self.project_id = project_id
+        self.interval = interval
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        with self.projects.conn.cursor() as cursor:
+            while True:
+                try:
+                    self.projects.heartbeat(self.project_id, cursor)
+                except psycopg.Error:
+                    logging.exception("Failed to renew lease of %s", self.project_id)
+                if self.stopped.wait(self.interval):
+                    break
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def store_stats(project_id: str, workdir: Path, projects: Projects):
+    # Stats are informational, they must not fail the project
+    try:
+        report = load_report(workdir)
+        with open(workdir / "report.json", "w") as f:
+            json.dump(report, f, indent=2)
+        projects.update_stats(project_id, report)
+    except Exception:
+        logging.exception("Could not store stats of project %s", project_id)
+
+
 def process_project(project_id: str, config: str, projects: Projects, makefile: str):
     logging.info("Process project %s", project_id)
     try:
         projects.update_state(project_id, ProjectState.RUNNING)
 
-        process = MakeProcess(project_id, config, makefile)
-        for line in process:
-            projects.append_log_entry(project_id, line)
+        with Heartbeat(projects, project_id):
+            process = MakeProcess(project_id, config, makefile)
+            with LogShipper(projects, project_id) as log:
+                for line in process:
+                    log.append(line)
 
-        retcode = process.wait()
+            retcode = process.wait()
+            store_stats(project_id, process.workdir, projects)
         if retcode != 0:
             projects.update_state(project_id, ProjectState.FAILED)
         else:
@@ -123,14 +380,69 @@ def process_project(project_id: str, config: str, projects: Projects, makefile:
         raise
 
 
+def run_job(db_uri: str, project_id: str, config: str, makefile: str, wakeup: int):
+    try:
+        with Projects(db_uri) as projects:
+            process_project(project_id, config, projects, makefile)
+    except Exception:
+        logging.exception("Project %s failed", project_id)
+    finally:
+        os.write(wakeup, b"\0")
+
+
+def run_daemon(db_uri: str, makefile: str, slots: int, poll: float, lease: float):
+    if lease < 3 * HEARTBEAT_INTERVAL:
+        raise ValueError(f"Lease must be at least {3 * HEARTBEAT_INTERVAL}s")
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    # Finished jobs write to this pipe to wake up the scheduler
+    wakeup_read, wakeup_write = os.pipe()
+
+    running: dict[str, threading.Thread] = {}
+    with Projects(db_uri) as projects:
+        projects.listen()
+        while not stopping.is_set() or running:
+            running = {pid: job for pid, job in running.items() if job.is_alive()}
+            for project_id in projects.requeue_stale(lease):
+                logging.warning("Requeued stale project %s", project_id)
+
+            while not stopping.is_set() and len(running) < slots:
+                project = projects.claim()
+                if project is None:
+                    break
+
+                project_id, config = project
+                job = threading.Thread(
+                    target=run_job,
+                    args=(db_uri, project_id, config, makefile, wakeup_write),
+                )
+                job.start()
+                running[project_id] = job
+
+            # Expired leases are checked well within the lease
+            if wakeup_read in projects.wait(min(poll, lease / 3), wakeup_read):
+                os.read(wakeup_read, 1024)
+
+
 @click.command()
 @click.argument("db-uri", required=False)
 @click.option("-p", "--project-id", default=None)
 @click.option("-f", "--makefile", default="/Makefile")
-def main(db_uri, project_id, makefile):
+@click.option("-d", "--daemon", is_flag=True, default=False)
+@click.option("-s", "--slots", type=int, default=1, help="Concurrent projects")
+@click.option("--poll", type=float, default=60, help="Seconds between queue checks")
+@click.option("--lease", type=float, default=300, help="Seconds until requeue")
+def main(db_uri, project_id, makefile, daemon, slots, poll, lease):
     if db_uri is None:
         db_uri = os.environ["POSTGRES_URL"]
 
+    if daemon:
+        run_daemon(db_uri, makefile, slots, poll, lease)
+        return
+
     with Projects(db_uri) as projects:
         if project_id is not None:
             project_id, config = projects.get_project(project_id)
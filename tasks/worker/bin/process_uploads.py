@@ -1,29 +1,176 @@
 #!/usr/bin/env python3
 
 import json
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from multiprocessing import get_context
 from pathlib import Path
-from typing import Any
+from threading import BoundedSemaphore
+from typing import Any, Iterator, Optional
 import logging
 from mimetypes import guess_type
 import click
 import numpy as np
 import cv2
 
+# Avoid splitting short videos, every chunk reopens the video and seeks
+MIN_CHUNK_FRAMES = 16
+
+# Frames are scored for sharpness on a grayscale copy of this width
+SHARPNESS_WIDTH = 480
+
+# Side length of the difference hash, yields HASH_SIZE**2 bits
+HASH_SIZE = 8
+
+FRAME_FORMATS = {
+    "png": (".png", None),
+    "jpg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def sharpness(frame: np.ndarray, width: int = SHARPNESS_WIDTH) -> float:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if gray.shape[1] > width:
+        height = round(gray.shape[0] * width / gray.shape[1])
+        gray = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+
+def frame_hash(frame: np.ndarray, size: int = HASH_SIZE) -> np.ndarray:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return (small[:, 1:] > small[:, :-1]).ravel()
+
+
+class Deduplicator:
+    """Drops frames whose hash is within `threshold` bits of the last kept frame"""
+
+    def __init__(self, threshold: Optional[int] = None):
+        self.threshold = threshold
+        self.kept: list[tuple[Path, Optional[np.ndarray]]] = []
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold is not None
+
+    def is_duplicate(self, frame_hash: Optional[np.ndarray]) -> bool:
+        if not self.enabled or not self.kept:
+            return False
+
+        distance = np.count_nonzero(frame_hash != self.kept[-1][1])
+        if distance <= self.threshold:
+            self.dropped += 1
+            return True
+        return False
+
+    def keep(self, path: Path, frame_hash: Optional[np.ndarray]):
+        self.kept.append((path, frame_hash))
+
+    def merge(self, other: "Deduplicator"):
+        # Frames at chunk boundaries were only compared within their chunk
+        self.dropped += other.dropped
+        for path, frame_hash in other.kept:
+            if self.is_duplicate(frame_hash):
+                path.unlink()
+            else:
+                self.keep(path, frame_hash)
+
+
+class FrameWriter:
+    """Resizes and encodes frames on a thread pool
+
+    At most `max_in_flight` decoded frames are queued, `write` blocks
+    until a slot is free.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        format: str = "png",
+        quality: int = 95,
+        max_size: int = 0,
+        threads: int = 2,
+        max_in_flight: int = 4,
+    ):
+        self.output_dir = Path(output_dir)
+        self.suffix, quality_flag = FRAME_FORMATS[format]
+        self.params = [] if quality_flag is None else [quality_flag, quality]
+        self.max_size = max_size
+
+        self.pool = ThreadPoolExecutor(threads)
+        self.slots = BoundedSemaphore(max(1, max_in_flight))
+        self.futures: list[Future] = []
+
+    def resize(self, frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        scale = self.max_size / max(height, width)
+        if not self.max_size or scale >= 1:
+            return frame
+
+        size = (round(width * scale), round(height * scale))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def _write(self, path: Path, frame: np.ndarray):
+        try:
+            if not cv2.imwrite(str(path), self.resize(frame), self.params):
+                raise IOError(f"Failed to write {path}")
+        finally:
+            self.slots.release()
+
+    def write(self, stem: str, frame: np.ndarray) -> Path:
+        path = self.output_dir / f"{stem}{self.suffix}"
+        self.slots.acquire()
+        self.futures.append(self.pool.submit(self._write, path, frame))
+        return path
+
+    def close(self):
+        wait(self.futures)
+        self.pool.shutdown()
+        for future in self.futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 
 class Video:
-    def __init__(self, path):
+    def __init__(self, path, keyframe_interval: Optional[int] = None):
         self.path = Path(path)
         self.cap = cv2.VideoCapture(str(path))
+        self._keyframe_interval = keyframe_interval
 
     def seek(self, frame: int) -> bool:
         return self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
 
+    def grab(self) -> bool:
+        return self.cap.grab()
+
+    def retrieve(self) -> np.ndarray:
+        ret, frame = self.cap.retrieve()
+        if not ret:
+            raise ValueError("Failed to retrieve frame")
+        return frame
+
     def read(self) -> np.ndarray:
         ret, frame = self.cap.read()
         if not ret:
             raise ValueError("Failed to read frame")
         return frame
 
+    @property
+    def position(self) -> int:
+        return int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+
     @property
     def fps(self) -> float:
         return self.cap.get(cv2.CAP_PROP_FPS)
@@ -32,6 +179,14 @@ class Video:
     def num_frames(self) -> int:
         return int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    @property
+    def keyframe_interval(self) -> int:
+        # OpenCV does not expose the GOP size, phone encoders
+        # typically emit about one keyframe per second
+        if self._keyframe_interval is None:
+            return max(1, round(self.fps))
+        return self._keyframe_interval
+
     @property
     def width(self) -> int:
         return int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -48,15 +203,66 @@ class Video:
             "height": self.height,
         }
 
-    def extract_frames(self, frames: list[int], output_dir: Path) -> list[Path]:
-        extracted = []
-        for num in sorted(frames):
-            self.seek(num)
-            frame = self.read()
-            path = output_dir / f"{self.path.stem}_{num:05d}.png"
-            cv2.imwrite(str(path), frame)
-            extracted.append(path)
-        return extracted
+    def iter_frames(self, frames: list[int]) -> Iterator[tuple[int, np.ndarray]]:
+        # Single forward pass: short gaps are skipped with grab(), which does
+        # not convert the frame, gaps longer than a GOP are cheaper to seek
+        keyframe_interval = self.keyframe_interval
+        position = 0
+        for num in sorted(set(frames)):
+            gap = num - position
+            if gap > keyframe_interval:
+                self.seek(num)
+            else:
+                for _ in range(gap):
+                    if not self.grab():
+                        raise ValueError(f"Failed to grab frame {position}")
+                    position += 1
+
+            if not self.grab():
+                raise ValueError(f"Failed to grab frame {num}")
+            position = num + 1
+
+            yield num, self.retrieve()
+
+    def iter_range(self, start: int, stop: int) -> Iterator[tuple[int, np.ndarray]]:
+        if self.position != start:
+            self.seek(start)
+
+        for num in range(start, stop):
+            if not self.grab():
+                break
+            yield num, self.retrieve()
+
+    def write_frame(
+        self, num: int, frame: np.ndarray, writer: FrameWriter, dedup: Deduplicator
+    ):
+        hashed = frame_hash(frame) if dedup.enabled else None
+        if dedup.is_duplicate(hashed):
+            return
+
+        path = writer.write(f"{self.path.stem}_{num:05d}", frame)
+        dedup.keep(path, hashed)
+
+    def extract_frames(
+        self, frames: list[int], writer: FrameWriter, dedup: Deduplicator
+    ) -> Deduplicator:
+        for num, frame in self.iter_frames(frames):
+            self.write_frame(num, frame, writer, dedup)
+        return dedup
+
+    def extract_sharpest(
+        self, windows: list[tuple[int, int]], writer: FrameWriter, dedup: Deduplicator
+    ) -> Deduplicator:
+        for start, stop in windows:
+            best, best_score = None, -1.0
+            for num, frame in self.iter_range(start, stop):
+                score = sharpness(frame)
+                if score > best_score:
+                    best, best_score = (num, frame), score
+
+            if best is not None:
+                self.write_frame(*best, writer, dedup)
+        return dedup
 
     def close(self):
         self.cap.release()
@@ -68,58 +274,218 @@ class Video:
         self.close()
 
 
-def handle_upload(upload: Path, config: dict[str, Any], outdir: Path):
+class SerialExecutor(Executor):
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def handle_upload(
+    upload: Path,
+    config: dict[str, Any],
+    output: dict[str, Any],
+    pool: Executor,
+    num_chunks: int = 1,
+) -> list[Future]:
     filetype, _ = guess_type(upload)
     if filetype.startswith("image"):
-        handle_image(upload, outdir)
+        handle_image(upload, output["output_dir"])
     elif filetype.startswith("video"):
-        handle_video(upload, config, outdir)
+        return handle_video(upload, config, output, pool, num_chunks)
     else:
         logging.error(
             "Error processing %s: Unsupported filetype %s", upload.name, filetype
         )
+    return []
 
 
 def handle_image(upload: Path, outdir: Path):
     upload.rename(outdir / upload.name)
 
 
-def handle_video(upload: Path, conf: list[str], outdir: Path):
+def select_frames(video: Video, conf: dict[str, Any]) -> list[int]:
+    ex_type = conf["type"]
+    if ex_type == "num":
+        num = int(conf["num"])
+        return [int(i * video.num_frames / num) for i in range(num)]
+    elif ex_type == "list":
+        return sorted({int(i) for i in conf["frames"]})
+
+    raise ValueError(f"Unknown extraction type {ex_type}")
+
+
+def select_windows(video: Video, conf: dict[str, Any]) -> list[tuple[int, int]]:
+    num = int(conf["num"])
+    bounds = [int(i * video.num_frames / num) for i in range(num + 1)]
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+
+def split_chunks(items: list, num_chunks: int, min_size: int = 1) -> list[list]:
+    if not items:
+        return []
+
+    num_chunks = max(1, min(num_chunks, len(items) // min_size))
+    size = -(-len(items) // num_chunks)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def extract_frames(
+    upload: Path,
+    frames: list[int],
+    output: dict[str, Any],
+    threshold: Optional[int],
+) -> Deduplicator:
+    with Video(upload) as video, FrameWriter(**output) as writer:
+        return video.extract_frames(frames, writer, Deduplicator(threshold))
+
+
+def extract_sharpest(
+    upload: Path,
+    windows: list[tuple[int, int]],
+    output: dict[str, Any],
+    threshold: Optional[int],
+) -> Deduplicator:
+    with Video(upload) as video, FrameWriter(**output) as writer:
+        return video.extract_sharpest(windows, writer, Deduplicator(threshold))
+
+
+def handle_video(
+    upload: Path,
+    conf: dict[str, Any],
+    output: dict[str, Any],
+    pool: Executor,
+    num_chunks: int = 1,
+) -> list[Future]:
     with Video(upload) as video:
-        ex_type = conf["type"]
-        if ex_type == "num":
-            num = int(conf["num"])
-            frame_idxs = [int(i * video.num_frames / num) for i in range(num)]
-        elif ex_type == "list":
-            frame_idxs = [int(i) for i in conf["frames"]]
-        else:
-            logging.error(
-                "Error processing %s: Unknown extraction type %s",
-                upload.name,
-                ex_type,
-            )
-
-        video.extract_frames(frame_idxs, outdir)
+        try:
+            if conf["type"] == "sharpest":
+                extract = extract_sharpest
+                chunks = split_chunks(select_windows(video, conf), num_chunks)
+            else:
+                extract = extract_frames
+                chunks = split_chunks(
+                    select_frames(video, conf), num_chunks, MIN_CHUNK_FRAMES
+                )
+        except ValueError as e:
+            logging.error("Error processing %s: %s", upload.name, e)
+            return []
+
+    # Long videos are split into contiguous frame ranges,
+    # each decoded by its own worker
+    threshold = conf.get("dedup")
+    return [pool.submit(extract, upload, chunk, output, threshold) for chunk in chunks]
+
+
+def iter_uploads(
+    uploads: Path, names: list[str], project_id: Optional[str]
+) -> Iterator[Path]:
+    if project_id is None:
+        yield from (uploads / name for name in names)
+    else:
+        # Imported here so that local runs do not need boto3
+        from transfer import Transfer, join_key
+
+        # Each upload is yielded as soon as its download completes
+        prefix = join_key(project_id, "uploads")
+        yield from Transfer().download(prefix, uploads, names)
 
 
 @click.command()
 @click.option("--outdir", "-o", required=True)
 @click.option("--frames", "-f", required=True)
 @click.option("--uploads", "-u", default="./uploads")
-def main(outdir, frames, uploads):
+@click.option(
+    "--project",
+    "-p",
+    default=None,
+    help="Stream the uploads of this project from S3 into the uploads directory",
+)
+@click.option("--workers", "-j", type=int, default=1)
+@click.option(
+    "--max-frames",
+    type=int,
+    default=None,
+    help="Maximum number of decoded frames held in memory",
+)
+@click.option("--format", "-x", type=click.Choice(list(FRAME_FORMATS)), default="png")
+@click.option("--quality", "-q", type=int, default=95, help="JPEG/WebP quality")
+@click.option(
+    "--max-size",
+    "-s",
+    type=int,
+    default=0,
+    help="Downscale frames to this maximum dimension, 0 keeps full resolution",
+)
+@click.option("--writer-threads", type=int, default=2)
+def main(
+    outdir,
+    frames,
+    uploads,
+    project,
+    workers,
+    max_frames,
+    format,
+    quality,
+    max_size,
+    writer_threads,
+):
     uploads = Path(uploads)
+    frames = json.loads(frames)
 
     outdir = Path(outdir)
     outdir.mkdir(parents=True, exist_ok=True)
 
-    for name, config in json.loads(frames).items():
-        upload = uploads / name
-        if upload.is_file():
-            logging.info("Processing %s", name)
-            handle_upload(upload, config, outdir)
-        else:
+    if max_frames is not None:
+        workers = min(workers, max_frames)
+        max_in_flight = max_frames // workers
+    else:
+        max_in_flight = 2 * writer_threads
+
+    output = {
+        "output_dir": outdir,
+        "format": format,
+        "quality": quality,
+        "max_size": max_size,
+        "threads": writer_threads,
+        "max_in_flight": max_in_flight,
+    }
+
+    # Uploads are downloaded on threads while the pool starts workers,
+    # forking then could copy a lock held by a transfer thread
+    if workers > 1:
+        pool = ProcessPoolExecutor(workers, mp_context=get_context("spawn"))
+    else:
+        pool = SerialExecutor()
+    with pool:
+        jobs = {}
+        for upload in iter_uploads(uploads, list(frames), project):
+            name = upload.relative_to(uploads).as_posix()
+            if upload.is_file():
+                logging.info("Processing %s", name)
+                config = frames[name]
+                jobs[name] = (
+                    config.get("dedup"),
+                    handle_upload(upload, config, output, pool, workers),
+                )
+
+        for name in frames.keys() - jobs.keys():
             logging.error("Could not process %s", name)
 
+        for name, (threshold, futures) in jobs.items():
+            dedup = Deduplicator(threshold)
+            for future in futures:
+                dedup.merge(future.result())
+
+            if dedup.enabled:
+                total = dedup.dropped + len(dedup.kept)
+                print(
+                    f"Dropped {dedup.dropped}/{total} near-duplicate frames of {name}"
+                )
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import json
+from pathlib import Path
+
+import click
+import numpy as np
+
+from splats import (
+    PlyFile,
+    PlyWriter,
+    bounds,
+    columns,
+    iter_ordered,
+    morton_order,
+    sigmoid,
+)
+
+# Splats of all levels, coarsest first
+LOD_FILE = "splats.ply"
+
+
+def finite_mask(vertices: np.ndarray) -> np.ndarray:
+    """Gaussians without NaN or infinite properties, e.g. from a diverged fit"""
+    return np.isfinite(columns(vertices, list(vertices.dtype.names))).all(axis=1)
+
+
+def prune_mask(
+    vertices: np.ndarray, scale_names: list[str], min_opacity: float, max_scale: float
+) -> np.ndarray:
+    """Gaussians that are visible and not huge"""
+    opaque = sigmoid(vertices["opacity"]) >= min_opacity
+    # Scales are stored as logarithms
+    bounded = columns(vertices, scale_names).max(axis=1) <= np.log(max_scale)
+    return opaque & bounded
+
+
+def log_importance(vertices: np.ndarray, scale_names: list[str]) -> np.ndarray:
+    """Opacity times volume, the splats coarse levels keep first"""
+    opacity = np.log(np.maximum(sigmoid(vertices["opacity"]), 1e-12))
+    return opacity + columns(vertices, scale_names).sum(axis=1)
+
+
+@click.command()
+@click.argument("model", type=click.Path(exists=True, dir_okay=False))
+@click.option("-o", "--output", required=True, help="Directory of the LOD levels")
+@click.option("--min-opacity", type=float, default=0.005)
+@click.option(
+    "--max-scale",
+    type=float,
+    default=0.5,
+    help="Largest gaussian axis relative to the scene diagonal",
+)
+@click.option("-l", "--levels", type=click.IntRange(min=1), default=4)
+@click.option(
+    "-r",
+    "--ratio",
+    type=click.FloatRange(0, 1, min_open=True, max_open=True),
+    default=0.25,
+    help="Fraction of splats kept by each coarser level",
+)
+def cli(model, output, min_opacity, max_scale, levels, ratio):
+    ply = PlyFile(model)
+    scale_names = ply.properties(r"scale_\d+")
+
+    # Levels are written along a Z-order curve for spatial locality
+    lo, hi = bounds(ply)
+    if not np.isfinite(hi - lo).all():
+        raise ValueError(f"{model} has no gaussians with a finite position")
+    order = morton_order(ply, lo, hi)
+    diagonal = float(np.linalg.norm(hi - lo))
+
+    finite = np.empty(len(ply), bool)
+    keep = np.empty(len(ply), bool)
+    scores = np.empty(len(ply), np.float32)
+    for start, vertices in iter_ordered(ply, order):
+        end = start + len(vertices)
+        finite[start:end] = finite_mask(vertices)
+        keep[start:end] = finite[start:end] & prune_mask(
+            vertices, scale_names, min_opacity, max_scale * diagonal
+        )
+        scores[start:end] = log_importance(vertices, scale_names)
+
+    num_finite = int(finite.sum())
+    if num_finite < len(ply):
+        print(f"Dropped {len(ply) - num_finite} non-finite gaussians")
+    del finite
+
+    num_kept = int(keep.sum())
+    print(f"Pruned {len(ply) - num_kept}/{len(ply)} gaussians")
+    if num_kept == 0:
+        raise ValueError(f"No gaussians of {model} are left after pruning")
+
+    # Level k keeps the ratio^k most important of the pruned splats
+    kept_scores = scores[keep]
+    thresholds = [-np.inf]
+    for level in range(1, levels):
+        num = max(1, int(np.ceil(num_kept * ratio**level)))
+        if num >= num_kept:
+            break
+        thresholds.append(np.partition(kept_scores, num_kept - num)[num_kept - num])
+    del kept_scores
+
+    # Each splat belongs to the coarsest level that keeps it
+    tiers = np.searchsorted(thresholds, scores, side="right") - 1
+    tier_counts = np.bincount(tiers[keep], minlength=len(thresholds))
+    # Level k holds its own splats and those of all coarser levels
+    counts = np.cumsum(tier_counts[::-1])[::-1].tolist()
+
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    for stale in output.glob("*.ply"):
+        stale.unlink()
+
+    # One file ordered from the coarsest to the finest level, so every level
+    # is a prefix of it and loading a finer level only adds its own splats
+    written = [counts[tier] - tier_counts[tier] for tier in range(len(thresholds))]
+    with PlyWriter(
+        output / LOD_FILE, {"vertex": (ply.vertices.dtype, num_kept)}
+    ) as out:
+        for start, vertices in iter_ordered(ply, order):
+            end = start + len(vertices)
+            for tier in range(len(thresholds)):
+                selected = vertices[keep[start:end] & (tiers[start:end] == tier)]
+                if len(selected):
+                    offset = written[tier]
+                    out["vertex"][offset : offset + len(selected)] = selected
+                    written[tier] += len(selected)
+        header_size = out.header_size
+
+    itemsize = ply.vertices.dtype.itemsize
+    index = {
+        "bounds": [lo.tolist(), hi.tolist()],
+        "file": LOD_FILE,
+        # Level k is the first `splats` vertices, bytes [0, bytes) of the file
+        "levels": [
+            {"splats": count, "bytes": header_size + count * itemsize}
+            for count in counts
+        ],
+    }
+    with open(output / "index.json", "w") as f:
+        json.dump(index, f, indent=2)
+
+    for level, count in enumerate(counts):
+        print(f"Level {level}: {count} gaussians")
+
+
+if __name__ == "__main__":
+    cli()
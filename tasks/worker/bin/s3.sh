@@ -15,20 +15,11 @@ if [ -z "$PROJECT_ID" ]; then
     exit 1
 fi
 
-if [ ! -z $S3_ENDPOINT ]; then
-    ENDPOINT_ARG="--endpoint-url=$S3_ENDPOINT"
-fi
-
 KEY=${3:-"."}
 
 case $OP in
-load)
-    # echo "Load ${PROJECT_ID}/${KEY}"
-    aws s3 sync --no-progress "$ENDPOINT_ARG" "s3://$S3_BUCKET/$PROJECT_ID/$KEY" "$KEY"
-    ;;
-store)
-    # echo "Store ${PROJECT_ID}/${KEY}"
-    aws s3 sync --no-progress "$ENDPOINT_ARG" "$KEY" "s3://$S3_BUCKET/$PROJECT_ID/$KEY"
+load | store)
+    exec transfer.py "$OP" "$PROJECT_ID" "$KEY"
     ;;
 *)
     usage
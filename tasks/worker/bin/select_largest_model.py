@@ -3,7 +3,8 @@
 from pathlib import Path
 import shutil
 import click
-from pycolmap import Reconstruction
+
+from colmap_model import Model
 
 
 @click.command()
@@ -15,9 +16,8 @@ def cli(models, images):
     if not models:
         raise ValueError(f"No models found at {models}")
 
-    counts: dict[Path, int] = {
-        model: Reconstruction(model).num_reg_images() for model in models
-    }
+    # Only the header of images.bin is read
+    counts: dict[Path, int] = {model: Model(model).num_images for model in models}
     largest: Path = max(counts, key=counts.get)
 
     if images is not None:
@@ -30,6 +30,13 @@ def cli(models, images):
     n_registered = counts[largest]
     print(f"Registered {n_registered} ({n_registered / n_matched:.1%}) images")
 
+    # Only header counts and the file size, instrument.py measures the rest
+    stats = Model(largest).stats(errors=False)
+    print(
+        f"Reconstructed {stats['points']} points, "
+        f"mean track length {stats['meanTrackLength']:.2f}"
+    )
+
     if len(models) >= 1:
         for model in set(counts) - {largest}:
             shutil.rmtree(model)
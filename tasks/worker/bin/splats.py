@@ -0,0 +1,195 @@
+import re
+from pathlib import Path
+from typing import Iterator, Union
+
+import numpy as np
+
+PLY_TYPES = {
+    "char": "i1",
+    "uchar": "u1",
+    "short": "<i2",
+    "ushort": "<u2",
+    "int": "<i4",
+    "uint": "<u4",
+    "float": "<f4",
+    "double": "<f8",
+}
+PLY_NAMES = {np.dtype(t): name for name, t in PLY_TYPES.items()}
+
+# Zeroth order spherical harmonics basis
+SH_C0 = 0.28209479177387814
+
+# Vertices read at once when streaming a file
+CHUNK_SIZE = 2**18
+
+
+class PlyFile:
+    """Memory-mapped binary little-endian PLY file"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.elements: dict[str, np.memmap] = {}
+
+        with open(self.path, "rb") as f:
+            if f.readline().strip() != b"ply":
+                raise ValueError(f"{path} is not a PLY file")
+
+            elements = []
+            while (line := f.readline().decode().strip()) != "end_header":
+                if (
+                    line.startswith("format")
+                    and line != "format binary_little_endian 1.0"
+                ):
+                    raise ValueError(f"Unsupported PLY format: {line}")
+                if line.startswith("element"):
+                    _, name, count = line.split()
+                    elements.append((name, int(count), []))
+                elif line.startswith("property"):
+                    _, kind, name = line.split()
+                    elements[-1][2].append((name, PLY_TYPES[kind]))
+            offset = f.tell()
+
+        for name, count, properties in elements:
+            dtype = np.dtype(properties)
+            self.elements[name] = np.memmap(
+                self.path, dtype, "r", offset=offset, shape=(count,)
+            )
+            offset += count * dtype.itemsize
+
+    @property
+    def vertices(self) -> np.memmap:
+        return self.elements["vertex"]
+
+    def __len__(self) -> int:
+        return len(self.vertices)
+
+    def properties(self, pattern: str) -> list[str]:
+        """Vertex properties matching `pattern`, ordered by their index"""
+        names = [n for n in self.vertices.dtype.names if re.fullmatch(pattern, n)]
+        return sorted(names, key=lambda n: int(re.sub(r"\D", "", n) or 0))
+
+    def iter_chunks(self, size: int = CHUNK_SIZE) -> Iterator[tuple[int, np.ndarray]]:
+        for start in range(0, len(self), size):
+            yield start, np.asarray(self.vertices[start : start + size])
+
+    def sh_degree(self) -> int:
+        coeffs = len(self.properties(r"f_rest_\d+")) // 3
+        return int(np.sqrt(coeffs + 1)) - 1
+
+
+class PlyWriter:
+    """Binary PLY file of known element sizes, filled through memory maps"""
+
+    def __init__(
+        self, path: Union[str, Path], elements: dict[str, tuple[np.dtype, int]]
+    ):
+        self.path = Path(path)
+
+        header = ["ply", "format binary_little_endian 1.0"]
+        for name, (dtype, count) in elements.items():
+            header.append(f"element {name} {count}")
+            for field in dtype.names:
+                kind = PLY_NAMES[dtype.fields[field][0]]
+                header.append(f"property {kind} {field}")
+        header.append("end_header\n")
+        encoded = "\n".join(header).encode()
+
+        size = len(encoded) + sum(d.itemsize * n for d, n in elements.values())
+        with open(self.path, "wb") as f:
+            f.write(encoded)
+            f.truncate(size)
+
+        self.header_size = len(encoded)
+        self.elements: dict[str, np.memmap] = {}
+        offset = len(encoded)
+        for name, (dtype, count) in elements.items():
+            if count:
+                self.elements[name] = np.memmap(
+                    self.path, dtype, "r+", offset=offset, shape=(count,)
+                )
+            offset += dtype.itemsize * count
+
+    def __getitem__(self, name: str) -> np.memmap:
+        return self.elements[name]
+
+    def close(self):
+        for element in self.elements.values():
+            element.flush()
+        self.elements = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def bounds(ply: PlyFile) -> tuple[np.ndarray, np.ndarray]:
+    """Bounding box of the finite vertex positions, infinite if there are none"""
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    for _, chunk in ply.iter_chunks():
+        xyz = positions(chunk)
+        xyz = xyz[np.isfinite(xyz).all(axis=1)]
+        if len(xyz):
+            lo = np.minimum(lo, xyz.min(axis=0))
+            hi = np.maximum(hi, xyz.max(axis=0))
+    return lo, hi
+
+
+def positions(vertices: np.ndarray) -> np.ndarray:
+    return np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=1)
+
+
+def columns(vertices: np.ndarray, names: list[str]) -> np.ndarray:
+    return np.stack([vertices[name] for name in names], axis=1)
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-x))
+
+
+def spread_bits(x: np.ndarray) -> np.ndarray:
+    """Insert two zero bits between each of the lower 21 bits"""
+    x = x.astype(np.uint64) & np.uint64(0x1FFFFF)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1F00000000FFFF)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1F0000FF0000FF)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100F00F00F00F00F)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10C30C30C30C30C3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+def morton_order(ply: PlyFile, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Vertex order along a Z-order curve, neighbours in space stay close
+
+    Vertices with a non-finite position go last.
+    """
+    codes = np.empty(len(ply), np.uint64)
+    scale = (2**21 - 1) / np.maximum(hi - lo, 1e-12)
+    for start, chunk in ply.iter_chunks():
+        xyz = positions(chunk)
+        finite = np.isfinite(xyz).all(axis=1)
+        xyz = np.where(finite[:, None], xyz, lo)
+        cells = np.clip((xyz - lo) * scale, 0, 2**21 - 1).astype(np.uint64)
+        chunk_codes = (
+            spread_bits(cells[:, 0])
+            | spread_bits(cells[:, 1]) << np.uint64(1)
+            | spread_bits(cells[:, 2]) << np.uint64(2)
+        )
+        chunk_codes[~finite] = np.iinfo(np.uint64).max
+        codes[start : start + len(chunk)] = chunk_codes
+    return np.argsort(codes, kind="stable")
+
+
+def iter_ordered(
+    ply: PlyFile, order: np.ndarray, size: int = CHUNK_SIZE
+) -> Iterator[tuple[int, np.ndarray]]:
+    """Read the vertices in `order`, chunk by chunk"""
+    for start in range(0, len(order), size):
+        index = order[start : start + size]
+        # Read in file order, then restore the requested order
+        ascending = np.argsort(index)
+        chunk = np.empty(len(index), ply.vertices.dtype)
+        chunk[ascending] = ply.vertices[index[ascending]]
+        yield start, chunk
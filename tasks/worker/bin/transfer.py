@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+
+import boto3
+import click
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+MiB = 2**20
+
+# Files transferred concurrently, and concurrent parts of each large file
+WORKERS = int(os.environ.get("S3_WORKERS", 8))
+PART_WORKERS = int(os.environ.get("S3_PART_WORKERS", 8))
+PART_SIZE = int(os.environ.get("S3_PART_SIZE", 16))
+
+# Objects per DeleteObjects request
+DELETE_BATCH = 1000
+
+
+def join_key(*parts: str) -> str:
+    return "/".join(part.strip("/") for part in parts if part not in ("", "."))
+
+
+class Transfer:
+    """Concurrent S3 transfers with sync semantics
+
+    Files are skipped when size and modification time match the other side,
+    like `aws s3 sync`. Large files are split into ranged parts that are
+    transferred in parallel over a shared connection pool.
+    """
+
+    def __init__(
+        self,
+        bucket: Optional[str] = None,
+        workers: int = WORKERS,
+        part_workers: int = PART_WORKERS,
+        part_size: int = PART_SIZE,
+    ):
+        self.bucket = bucket or os.environ["S3_BUCKET"]
+        self.workers = workers
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=os.environ.get("S3_ENDPOINT") or None,
+            config=Config(
+                max_pool_connections=workers * part_workers,
+                retries={"max_attempts": 10, "mode": "adaptive"},
+            ),
+        )
+        self.config = TransferConfig(
+            multipart_threshold=part_size * MiB,
+            multipart_chunksize=part_size * MiB,
+            max_concurrency=part_workers,
+        )
+
+    def list(self, prefix: str) -> dict[str, dict[str, Any]]:
+        """Objects stored at `prefix` itself or below `prefix/`"""
+        objects = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                if key == prefix or key.startswith(prefix.rstrip("/") + "/"):
+                    objects[key] = obj
+        return objects
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def download_file(self, key: str, obj: dict[str, Any], path: Path) -> Path:
+        mtime = obj["LastModified"].timestamp()
+        if path.is_file():
+            stat = path.stat()
+            if stat.st_size == obj["Size"] and stat.st_mtime == mtime:
+                return path
+
+        # Readers never see a partial file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+        try:
+            self.client.download_file(self.bucket, key, str(tmp), Config=self.config)
+            os.utime(tmp, (mtime, mtime))
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return path
+
+    def download(
+        self,
+        prefix: str,
+        dest: Path,
+        names: Optional[Iterable[str]] = None,
+        delete: bool = False,
+    ) -> Iterator[Path]:
+        """Download `prefix` to `dest`, yielding every file as soon as it lands
+
+        A single object stored at `prefix` is written to `dest` itself.
+        `names` restricts the download to these paths relative to `prefix`.
+        """
+        dest = Path(dest)
+        files = {}
+        for key, obj in self.list(prefix).items():
+            name = key[len(prefix) :].lstrip("/")
+            files[dest / name if name else dest] = (key, obj)
+
+        if names is not None:
+            names = set(names)
+            files = {
+                path: entry
+                for path, entry in files.items()
+                if path.relative_to(dest).as_posix() in names
+            }
+
+        if delete and dest.is_dir():
+            for path in dest.rglob("*"):
+                if path.is_file() and path not in files:
+                    path.unlink()
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [
+                pool.submit(self.download_file, key, obj, path)
+                for path, (key, obj) in files.items()
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def upload_file(self, path: Path, key: str, remote: Optional[dict[str, Any]]):
+        if remote is not None:
+            stat = path.stat()
+            if (
+                stat.st_size == remote["Size"]
+                and stat.st_mtime <= remote["LastModified"].timestamp()
+            ):
+                return
+        self.client.upload_file(str(path), self.bucket, key, Config=self.config)
+
+    def upload(self, src: Path, prefix: str, delete: bool = False) -> int:
+        """Upload the file or directory `src` to `prefix`"""
+        src = Path(src)
+        if src.is_file():
+            files = {prefix: src}
+        else:
+            files = {
+                join_key(prefix, path.relative_to(src).as_posix()): path
+                for path in sorted(src.rglob("*"))
+                if path.is_file()
+            }
+
+        remote = self.list(prefix)
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [
+                pool.submit(self.upload_file, path, key, remote.get(key))
+                for key, path in files.items()
+            ]
+            for future in as_completed(futures):
+                future.result()
+
+        if delete:
+            stale = [key for key in remote if key not in files]
+            for i in range(0, len(stale), DELETE_BATCH):
+                self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={
+                        "Objects": [{"Key": k} for k in stale[i : i + DELETE_BATCH]]
+                    },
+                )
+        return len(files)
+
+
+@click.group()
+@click.option("-j", "--workers", type=int, default=WORKERS)
+@click.option("--part-workers", type=int, default=PART_WORKERS)
+@click.option("--part-size", type=int, default=PART_SIZE, help="MiB")
+@click.pass_context
+def cli(ctx, workers, part_workers, part_size):
+    ctx.obj = Transfer(workers=workers, part_workers=part_workers, part_size=part_size)
+
+
+@cli.command()
+@click.argument("project_id")
+@click.argument("key", default=".")
+@click.pass_obj
+def load(transfer: Transfer, project_id, key):
+    """Download KEY of a project into the working directory"""
+    num = sum(1 for _ in transfer.download(join_key(project_id, key), Path(key)))
+    print(f"Downloaded {num} files to {key}")
+
+
+@cli.command()
+@click.argument("project_id")
+@click.argument("key", default=".")
+@click.pass_obj
+def store(transfer: Transfer, project_id, key):
+    """Upload KEY of the working directory to the project"""
+    num = transfer.upload(Path(key), join_key(project_id, key))
+    print(f"Uploaded {num} files from {key}")
+
+
+if __name__ == "__main__":
+    cli()